@@ -0,0 +1,190 @@
+"""
+I benchmark the deployer on a synthetic node folder against a local stand-in of the Sesam and Vault APIs.
+Every stage is run --repeat times for the time (the fastest run counts) and once more under tracemalloc for the peak
+memory. Results are compared with the baseline of the same scenario, and the exit code is 1 if a stage regressed.
+
+    python benchmarks/run_benchmarks.py --pipes 2000 --fan-in 3 --extra-nodes 4 --update-baseline
+"""
+from argparse import ArgumentParser
+from json import dumps as dump_json, loads as load_json
+from os import environ, path as os_path
+from sys import exit, path as sys_path
+from tempfile import mkdtemp
+from time import perf_counter
+import tracemalloc
+
+HERE = os_path.dirname(os_path.abspath(__file__))
+sys_path.insert(0, os_path.join(HERE, '..', 'service'))
+
+from synthetic_node import ENV, generate_node_folder
+from stand_in import StandIn
+
+STAGES = ['get_node_info', 'generate_config', 'find_variables_and_secrets', 'verify_secrets', 'do_diff', 'deploy',
+          'deploy_incremental']
+
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark the deployer on a synthetic node folder.')
+    parser.add_argument('--pipes', type=int, default=1000, help='Master node pipes')
+    parser.add_argument('--fan-in', type=int, default=3, help='Datasets read by each merge pipe')
+    parser.add_argument('--extra-nodes', type=int, default=2)
+    parser.add_argument('--extra-node-pipes', type=int, default=20, help='Pipes per extra node')
+    parser.add_argument('--template-set', default='full', choices=['full', 'pipes'])
+    parser.add_argument('--changed', type=float, default=0.05, help='Share of running config which differs')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency of each stand-in API request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages to run')
+    parser.add_argument('--baseline', default=os_path.join(HERE, 'baseline.json'))
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown or memory growth, 0.25 = 25%%')
+    parser.add_argument('--min-seconds', type=float, default=0.02, help='Slowdowns below this are noise')
+    parser.add_argument('--min-bytes', type=int, default=1 << 20, help='Memory growth below this is noise')
+    parser.add_argument('--folder', help='Where to generate the node folder. Defaults to a temporary folder')
+    parser.add_argument('--report', help='Write the results as json to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    folder = args.folder or mkdtemp(prefix='deployer-benchmark-')
+    extra_nodes = generate_node_folder(folder, pipes=args.pipes, fan_in=args.fan_in, extra_nodes=args.extra_nodes,
+                                       extra_node_pipes=args.extra_node_pipes, template_set=args.template_set)
+
+    # The deployer reads its settings from the environment in load_config
+    environ.setdefault('LOG_LEVEL', 'ERROR')
+    environ.update({'NODE_FOLDER': folder, 'ENVIRONMENT': 'ci', 'DRY_RUN': 'true', 'VERIFY_SECRETS': 'false',
+                    'VERIFY_VARIABLES': 'false'})
+    import deployer
+    deployer.load_config()
+    from Node import Node
+    from Vaulter import Vaulter
+    from config_creator import TEMPLATE_REGISTRY, generate_config, get_vars_from_master
+    from config_loader import ConfigLoader
+
+    def master_node(loader=None, extra=True):
+        node = Node(path=folder, name='master', whitelist_path=f'deployment/whitelist-{ENV}.txt',
+                    verify_vars=False, verify_secrets=True, upload_vars_from_file=f'variables/variables-{ENV}.json',
+                    verify_vars_from_files=[f'variables/variables-{ENV}.json'])
+        node.get_node_info(loader or ConfigLoader())
+        if extra:
+            generate_all(node, loader or ConfigLoader())
+            node.find_variables_and_secrets()
+        return node
+
+    def generate_all(node, loader):
+        for name in extra_nodes:
+            extra_node = Node(path=folder, name=name, whitelist_path=f'deployment/whitelist-{ENV}.txt',
+                              verify_vars=False, verify_secrets=False, upload_vars_from_file=None,
+                              verify_vars_from_files=[])
+            extra_node.get_node_info(loader)
+            generate_config(node, extra_node, f'{folder}/extra_nodes/{name}/')
+            get_vars_from_master(node, extra_node)
+
+    prepared = master_node()
+    stand_in = StandIn(running_conf=running_conf(prepared.conf, args.changed), latency=args.latency_ms / 1000)
+    stand_in.start()
+
+    def diff_setup():
+        deployer.config.SLACK_API_TOKEN = None
+        return master_node()
+
+    def deploy_setup(mode):
+        def setup():
+            node = master_node()
+            stand_in.running_conf = {c['_id']: c for c in running_conf(node.conf, args.changed)}
+            deployer.config.DEPLOY_MODE = mode
+            return node, deployer.do_diff(stand_in.url, 'jwt', node)
+        return setup
+
+    def verify_secrets_setup():
+        node = master_node()
+        return node, Vaulter(url=stand_in.url, token='token', mount_point='kv', auth_type='git-token')
+
+    stages = {
+        'get_node_info': (lambda: None, lambda _: master_node(extra=False)),
+        'generate_config': (lambda: master_node(extra=False),
+                            lambda node: generate_all(node, ConfigLoader())),
+        'find_variables_and_secrets': (master_node, lambda node: node.find_variables_and_secrets()),
+        'verify_secrets': (verify_secrets_setup, lambda s: s[0].secret_verification(s[1])),
+        'do_diff': (diff_setup, lambda node: deployer.do_diff(stand_in.url, 'jwt', node)),
+        'deploy': (deploy_setup('full'),
+                   lambda s: deployer.deploy(stand_in.url, 'jwt', True, True, s[0], diff=s[1])),
+        'deploy_incremental': (deploy_setup('incremental'),
+                               lambda s: deployer.deploy(stand_in.url, 'jwt', True, True, s[0], diff=s[1]))
+    }
+    results = {}
+    for stage in args.stages.split(','):
+        setup, run = stages[stage]
+        TEMPLATE_REGISTRY.templates.clear()  # Every run compiles the templates, like a new deployer process
+        results[stage] = measure(setup, run, args.repeat)
+        print(f'{stage:28} {results[stage]["seconds"] * 1000:10.1f} ms {results[stage]["peak_bytes"] / 2**20:10.1f} MiB')
+    stand_in.stop()
+
+    scenario = (f'pipes={args.pipes},fan_in={args.fan_in},extra_nodes={args.extra_nodes},'
+                f'extra_node_pipes={args.extra_node_pipes},templates={args.template_set},changed={args.changed},'
+                f'latency_ms={args.latency_ms}')
+    baselines = load_json(open(args.baseline).read()) if os_path.isfile(args.baseline) else {}
+    regressions = find_regressions(results, baselines.get(scenario, {}), args)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(dump_json({'scenario': scenario, 'results': results, 'regressions': regressions}, indent=2))
+    if args.update_baseline:
+        baselines[scenario] = results
+        with open(args.baseline, 'w') as f:
+            f.write(dump_json(baselines, indent=2, sort_keys=True))
+        print(f'Stored baseline for {scenario} in {args.baseline}')
+    exit(1 if len(regressions) != 0 else 0)
+
+
+def running_conf(conf: list, changed: float):
+    """
+    I return a running config which differs from conf: a share of changed is changed, removed or missing.
+    """
+    step = max(1, int(1 / changed)) if changed > 0 else len(conf) + 1
+    running = []
+    for i, c in enumerate(conf):
+        if i % step == 0:
+            running.append(dict(c, comment='changed'))
+        elif i % step == 1:
+            continue  # Added in the new config
+        else:
+            running.append(c)
+    running.append({'_id': 'removed-pipe', 'type': 'pipe', 'source': {'type': 'embedded', 'entities': []}})
+    return running
+
+
+def measure(setup, run, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        state = setup()
+        start = perf_counter()
+        run(state)
+        timings.append(perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+
+def find_regressions(results: dict, baseline: dict, args):
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]
+        if result['seconds'] > before['seconds'] * (1 + args.tolerance) \
+                and result['seconds'] - before['seconds'] > args.min_seconds:
+            regressions.append(f'{stage}: {before["seconds"] * 1000:.1f} ms -> {result["seconds"] * 1000:.1f} ms')
+        if result['peak_bytes'] > before['peak_bytes'] * (1 + args.tolerance) \
+                and result['peak_bytes'] - before['peak_bytes'] > args.min_bytes:
+            regressions.append(f'{stage}: {before["peak_bytes"] / 2**20:.1f} MiB -> '
+                               f'{result["peak_bytes"] / 2**20:.1f} MiB peak memory')
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+from gzip import decompress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as dump_json, loads as load_json
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import unquote, urlparse
+
+
+class StandIn:
+    """
+    I am a local stand-in for the Sesam node API and the Vault KV v2 API, so the deployer can be benchmarked without
+    talking to real services. Every request waits latency seconds, to act a bit like a network.
+    Requests are logged in calls, and requests to a path, or a (method, path), in failing get a 500 reply, e.g. to
+    test fallbacks.
+    """
+
+    def __init__(self, running_conf: list = None, latency=0.0, missing_secrets: list = None):
+        self.running_conf = {c['_id']: c for c in running_conf or []}
+        self.env = {}
+        self.latency = latency
+        self.missing_secrets = missing_secrets or []
+        self.requests = 0
+        self.calls = []  # [(<method>, <path>), ...]
+        self.failing = {}  # {<path> or (<method>, <path>): <number of requests to fail, or None for all>}
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real services
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body=None):
+                content = b'' if body is None else body if type(body) is bytes else dump_json(body).encode('UTF-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def body(self):
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    content = b''.join(self.chunks())
+                else:
+                    content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    content = decompress(content)
+                return load_json(content) if content else None
+
+            def chunks(self):
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    chunk = self.rfile.read(size)
+                    self.rfile.readline()  # The line break after each chunk, and the end of the body
+                    if size == 0:
+                        return
+                    yield chunk
+
+            def handle_request(self, method):
+                path = urlparse(self.path).path
+                with stand_in.lock:
+                    stand_in.requests += 1
+                    stand_in.calls.append((method, path))
+                if stand_in.latency:
+                    sleep(stand_in.latency)
+                body = self.body() if method in ['PUT', 'POST'] else None
+                with stand_in.lock:
+                    key = next((k for k in [(method, path), path] if k in stand_in.failing), None)
+                    fail = key is not None and stand_in.failing[key] != 0
+                    if fail and stand_in.failing[key] is not None:
+                        stand_in.failing[key] -= 1
+                if fail:
+                    return self.reply(500, {'message': 'Failing on purpose'})
+                if path.startswith('/v1/'):
+                    return self.vault(method, path)
+                parts = [unquote(p) for p in path.split('/')[2:]]  # /api/<parts>
+                with stand_in.lock:
+                    if parts[0] == 'config':  # Config groups are not kept apart
+                        if method == 'GET':
+                            return self.reply(200, list(stand_in.running_conf.values()))
+                        stand_in.running_conf = {c['_id']: c for c in body}
+                        return self.reply(200, [])
+                    if parts[0] == 'env':
+                        if method == 'GET':
+                            return self.reply(200, stand_in.env)
+                        stand_in.env = body
+                        return self.reply(200, {})
+                    if parts[0] == 'secrets':
+                        return self.reply(200, {})
+                    if parts[0] == 'utils':  # reformat-config
+                        return self.reply(200, dump_json(body, indent=2, sort_keys=True).encode('UTF-8'))
+                    if parts[0] in ['pipes', 'systems']:
+                        if method == 'POST':
+                            stand_in.running_conf.update({c['_id']: c for c in body})
+                        elif method == 'PUT':
+                            stand_in.running_conf[parts[1]] = body
+                        elif method == 'DELETE':
+                            if stand_in.running_conf.pop(parts[1], None) is None:
+                                return self.reply(404)
+                        return self.reply(200, [])
+                return self.reply(404)
+
+            def vault(self, method, path):
+                if path.startswith('/v1/auth/'):
+                    if method == 'POST':
+                        return self.reply(200, {'auth': {'client_token': 'stand-in-token'}})
+                    return self.reply(200, {'data': {'id': 'stand-in-token'}})  # lookup-self
+                secret = path.split('/data/', 1)[1]
+                if secret in stand_in.missing_secrets:
+                    return self.reply(404, {'errors': []})
+                return self.reply(200, {'data': {'data': {'value': f'value-of-{secret}'}}})
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+
+        return Handler
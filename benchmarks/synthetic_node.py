@@ -0,0 +1,96 @@
+from json import dumps as dump_json
+from os import makedirs, path as os_path
+from random import Random
+from shutil import copyfile, rmtree
+
+TEMPLATE_SOURCE = os_path.join(os_path.dirname(os_path.abspath(__file__)), '..', 'template_node_root_folder',
+                               'extra_nodes', 'eidsiva')
+# Template files copied into every extra node folder, by template set
+TEMPLATE_SETS = {
+    'full': ['node-metadata.conf.json',
+             'pipe_on_extra_from_extra_to_master.json', 'pipe_on_extra_from_master_to_extra.json',
+             'pipe_on_master_from_extra_to_master.json', 'pipe_on_master_from_master_to_extra.json',
+             'system_on_extra_from_extra_to_master.json', 'system_on_extra_from_master_to_extra.json'],
+    'pipes': ['node-metadata.conf.json',
+              'pipe_on_extra_from_extra_to_master.json', 'pipe_on_extra_from_master_to_extra.json',
+              'pipe_on_master_from_extra_to_master.json', 'pipe_on_master_from_master_to_extra.json']
+}
+ENV = 'test'
+
+
+def generate_node_folder(path: str, pipes=1000, fan_in=3, extra_nodes=2, extra_node_pipes=20, template_set='full',
+                         variables=50, secrets=20, seed=0):
+    """
+    I write a NODE_FOLDER in the shape of template_node_root_folder to path and return the names of the extra nodes:
+    node/ with the metadata, systems, pipes, whitelist and variables files, and extra_nodes/<name>/ with templates.
+
+    Every fan_in + 1'th master pipe reads embedded entities, the others merge fan_in datasets of earlier pipes.
+    Each extra node gets extra_node_pipes pipes, half reading from the master node and half read by the master node.
+    """
+    random = Random(seed)
+    rmtree(path, ignore_errors=True)
+    for folder in ['node/pipes', 'node/systems', 'node/deployment', 'node/variables']:
+        makedirs(f'{path}/{folder}')
+    files = {'node-metadata.conf.json': {'_id': 'node', 'type': 'metadata', 'namespaced_identifiers': True}}
+
+    for i in range(max(1, secrets // 5)):
+        files[f'systems/system-{i}.conf.json'] = {
+            '_id': f'system-{i}',
+            'type': 'system:url',
+            'url_pattern': f'$ENV(var-{i % variables})/%s',
+            'headers': {f'x-key-{k}': f'$SECRET(secret-{(i * 5 + k) % secrets})' for k in range(5)}
+        }
+
+    datasets = []
+    for i in range(pipes):
+        _id = f'pipe-{i}'
+        if i % (fan_in + 1) == 0 or len(datasets) < fan_in:
+            source = {'type': 'embedded', 'entities': [{'_id': f'{_id}-{k}', 'value': k} for k in range(3)]}
+        else:
+            sources = random.sample(datasets, fan_in)
+            source = {'type': 'merge', 'datasets': [f'{d} {d.replace("-", "")}' for d in sources],
+                      'equality': [['eq', f'{sources[0].replace("-", "")}.id', f'{s.replace("-", "")}.id']
+                                   for s in sources[1:]]}
+        files[f'pipes/{_id}.conf.json'] = {
+            '_id': _id,
+            'type': 'pipe',
+            'source': source,
+            'transform': {'type': 'dtl', 'rules': {'default': [
+                ['copy', '*'],
+                ['add', 'endpoint', f'$ENV(var-{random.randrange(variables)})'],
+                ['add', 'checksum', ['hex', ['sha256', '_S.value']]]
+            ]}},
+            'sink': {'type': 'dataset', 'dataset': _id},
+            'pump': {'schedule_interval': random.choice([60, 300, 3600])}
+        }
+        if random.random() < 0.1:
+            files[f'pipes/{_id}.conf.json']['source']['token'] = f'$SECRET(secret-{random.randrange(secrets)})'
+        datasets.append(_id)
+
+    names = [f'extra-{n}' for n in range(extra_nodes)]
+    for name in names:
+        for i in range(extra_node_pipes):
+            _id = f'{name}-pipe-{i}'
+            if i % 2 == 0:  # Reads a master dataset, so it is sent from master to the extra node
+                source = {'type': 'dataset', 'dataset': random.choice(datasets)}
+            else:  # Read by a new master pipe, so it is sent from the extra node to master
+                source = {'type': 'embedded', 'entities': [{'_id': f'{_id}-0'}]}
+                files[f'pipes/{_id}-consumer.conf.json'] = {
+                    '_id': f'{_id}-consumer', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': _id}}
+            files[f'pipes/{_id}.conf.json'] = {
+                '_id': _id, 'type': 'pipe', 'source': source, 'sink': {'type': 'dataset', 'dataset': _id},
+                'metadata': {'node': name}}
+        makedirs(f'{path}/extra_nodes/{name}')
+        for filename in TEMPLATE_SETS[template_set]:
+            copyfile(f'{TEMPLATE_SOURCE}/{filename}', f'{path}/extra_nodes/{name}/{filename}')
+
+    for filename, conf in files.items():
+        with open(f'{path}/node/{filename}', 'w') as f:
+            f.write(dump_json(conf, indent=2))
+    with open(f'{path}/node/deployment/whitelist-{ENV}.txt', 'w') as f:
+        f.write('\n'.join(files))
+    all_variables = {f'var-{i}': f'https://example-{i}.com' for i in range(variables)}
+    all_variables['master-endpoint'] = 'https://master.example.com'
+    with open(f'{path}/node/variables/variables-{ENV}.json', 'w') as f:
+        f.write(dump_json(all_variables, indent=2))
+    return names
@@ -1,9 +1,13 @@
-from json import loads as load_json, dumps as dump_json
-from re import findall as regex_findall
 from sys import exit
+from typing import TYPE_CHECKING
 
-from Vaulter import Vaulter
-from sesamutils import sesam_logger
+from config_loader import ConfigLoader, find_references, pipe_flow, recursive_getter
+from lineage import LineageGraph
+from logger import get_logger
+from variable_index import VARIABLE_INDEX
+
+if TYPE_CHECKING:  # hvac is only imported when secrets are verified
+    from Vaulter import Vaulter
 
 
 class Node:
@@ -29,52 +33,53 @@ class Node:
             self.upload_vars_from_file: str = self.node_path + '/' + upload_vars_from_file
         self.verify_vars_from_files: list = [self.node_path + '/' + f for f in verify_vars_from_files]
 
-        self.pipes = {}
+        self.graph = LineageGraph()
+        self.pipes = self.graph.pipes
         self.conf = []
         self.config_vars = []
         self.config_secrets = []
+        self.variable_locations = {}  # {<variable>: [<file>, ...]}
+        self.secret_locations = {}  # {<secret>: [<file>, ...]}
+        self.references = {}  # {<_id>: (<conf>, <file>, [<$ENV references>], [<$SECRET references>])}
         self.upload_vars = {}
         self.upload_secrets = {}
 
-        self.LOGGER = sesam_logger(f'Node {self.name}')
+        self.LOGGER = get_logger(f'Node {self.name}')
 
-    def get_node_info(self):
+    def get_node_info(self, loader: ConfigLoader = None):
+        if loader is None:
+            loader = ConfigLoader()
         care_about_node = self.name is not None
         missing_files = []
-        for filename in list(
-                filter(
-                    lambda x: x != '',
-                    open(self.whitelist_path, 'r').read().split('\n')
-                )
-        ):  # for file in whitelist
-            try:
-                care_about_this_file = care_about_node is not True
-                curfile = load_json(open(f'{self.node_path}/{filename}', 'r').read())
-                if care_about_node:
-                    file_belongs_to_node = recursive_getter(curfile, "metadata.node")
-                    if file_belongs_to_node is not None:  # if path ^ is not in file
-                        care_about_this_file = file_belongs_to_node == self.name  # true if node is correct and is same
-                    else:
-                        care_about_this_file = self.name == 'master'  # if master True if other False
-
-                if care_about_this_file:
-                    self.conf.append(curfile)
-
-                    # Tests to add pipe flows to node. {<pipe_name> : {source: str, sink: str}}
-                    pipe_source_type = recursive_getter(curfile, 'source.type')
-                    if pipe_source_type is not None:
-                        self.add_pipe_flow(curfile)
-
-            except FileNotFoundError as e:
+        for filename, entry in loader.load(self.node_path, self.whitelist_path):  # for file in whitelist
+            if entry is None:
                 self.LOGGER.critical(f'Could not find file {filename} in config!')
                 missing_files.append(filename)
+                continue
+            curfile = entry['conf']
+            care_about_this_file = care_about_node is not True
+            if care_about_node:
+                file_belongs_to_node = recursive_getter(curfile, "metadata.node")
+                if file_belongs_to_node is not None:  # if path ^ is not in file
+                    care_about_this_file = file_belongs_to_node == self.name  # true if node is correct and is same
+                else:
+                    care_about_this_file = self.name == 'master'  # if master True if other False
+
+            if care_about_this_file:
+                self.add_conf(curfile)
+                self.references[curfile['_id']] = (curfile, filename, entry['vars'], entry['secrets'])
+
+                # Tests to add pipe flows to node. {<pipe_name> : {source: str, sink: str}}
+                if entry['pipe_flow'] is not None:
+                    self.graph.add_pipe_flow(curfile['_id'], entry['pipe_flow'])
+
         if self.read_variables_file:
-            self.upload_vars = load_json(open(self.upload_vars_from_file, 'r').read())
+            self.upload_vars = dict(VARIABLE_INDEX.get(self.upload_vars_from_file))
         if len(missing_files) != 0:
             self.LOGGER.critical(f'Could not find files {missing_files} in config! Exiting.')
             exit(-1)
 
-    def verify_node_info(self, vault: Vaulter, search_conf=False, verify_secrets=False, verify_vars=False):
+    def verify_node_info(self, vault: 'Vaulter', search_conf=False, verify_secrets=False, verify_vars=False):
         if search_conf:
             self.find_variables_and_secrets()
         if verify_secrets:
@@ -90,15 +95,18 @@ class Node:
                 self.LOGGER.critical('Verify vars is true but files to verify from is not specified!')
                 exit(-4)
             else:
-                all_vars = {}
-                for f in self.verify_vars_from_files:
-                    all_vars.update(load_json(open(f).read()))
-                missing_vars = []
-                for var in self.config_vars:
-                    if var not in all_vars:
-                        missing_vars.append(var)
-                if len(missing_vars) != 0:
-                    self.LOGGER.critical(f'Variables verification failed! Missing vars: "{missing_vars}"')
+                # Every file is checked on its own, so a variable missing in only one environment is found
+                try:
+                    gaps = VARIABLE_INDEX.missing(self.config_vars, self.verify_vars_from_files)
+                except FileNotFoundError as e:
+                    self.LOGGER.critical(f'Could not find variables file "{e.filename}"!')
+                    return False
+                if len(gaps) != 0:
+                    for f, missing_vars in gaps.items():
+                        self.LOGGER.critical(f'Variables verification failed for "{f[len(self.node_path) + 1:]}"! '
+                                             f'Missing vars: "{missing_vars}"')
+                    for var in dict.fromkeys(var for missing_vars in gaps.values() for var in missing_vars):
+                        self.LOGGER.critical(f'Variable "{var}" is used in: {self.variable_locations.get(var, [])}')
                     return False
                 else:
                     self.LOGGER.info(f'Variables verification succeeded :)')
@@ -106,79 +114,57 @@ class Node:
                     return True
         return True  # If verify vars is false
 
-    def secret_verification(self, vault: Vaulter):
+    def secret_verification(self, vault: 'Vaulter'):
         self.upload_secrets = vault.get_secrets(self.config_secrets)
-        if vault.verify() is False:
-            self.LOGGER.critical(f'Secrets verification failed! Missing secrets: "{vault.get_missing_secrets()}"')
+        if vault.verify(self.config_secrets) is False:
+            missing_secrets = vault.get_missing_secrets(self.config_secrets)
+            self.LOGGER.critical(f'Secrets verification failed! Missing secrets: "{missing_secrets}"')
+            for secret in missing_secrets:
+                self.LOGGER.critical(f'Secret "{secret}" is used in: {self.secret_locations.get(secret, [])}')
             return False
         else:
             self.LOGGER.info(f'Secrets verification succeeded :)')
             return True
 
     def find_variables_and_secrets(self):
-        str_conf = dump_json(self.conf)
-        self.config_vars = regex_findall(r'\$ENV\((\S*?)\)', str_conf)
-        self.config_secrets = regex_findall(r'\$SECRET\((\S*?)\)', str_conf)
+        """
+        References of loaded files were found while loading them, so only generated config is searched here.
+        """
+        self.variable_locations = {}
+        self.secret_locations = {}
+        for conf in self.conf:
+            if conf['_id'] not in self.references or self.references[conf['_id']][0] is not conf:
+                self.references[conf['_id']] = (conf, f'{conf["_id"]} (generated)', *find_references(conf))
+            _, location, conf_vars, conf_secrets = self.references[conf['_id']]
+            for var in conf_vars:
+                self.variable_locations.setdefault(var, []).append(location)
+            for secret in conf_secrets:
+                self.secret_locations.setdefault(secret, []).append(location)
+        self.config_vars = list(self.variable_locations)
+        self.config_secrets = list(self.secret_locations)
+
+    def add_conf(self, conf: dict):
+        self.conf.append(conf)
+        self.graph.add_conf(conf)
+
+    def remove_conf(self, conf: dict):
+        self.conf.remove(conf)
+        self.graph.remove_conf(conf)
 
     def add_pipe_flow(self, pipe_conf):
-
-        pipe_id = pipe_conf['_id']
-        self.pipes[pipe_id] = {}
-
-        # Get pipe sources
-        source_type = recursive_getter(pipe_conf, 'source.type')
-        true_source = None
-        if source_type == 'dataset':
-            true_source = recursive_getter(pipe_conf, 'source.dataset')
-        elif source_type == 'merge':
-            true_source = recursive_getter(pipe_conf, 'source.datasets')
-
-        if true_source is not None:
-            if type(true_source) == list:
-                self.pipes[pipe_id]['source'] = [e.split(" ")[0] for e in true_source]
-            else:
-                self.pipes[pipe_id]['source'] = [true_source]
-
-        sink_type = recursive_getter(pipe_conf, 'sink.type')
-        true_sink = None
-        if sink_type is not None:
-            if sink_type == 'dataset':
-                true_sink = recursive_getter(pipe_conf, 'sink.dataset')
-        if true_sink is None:  # because pipe can have sink type dataset without specifying dataset name.
-            true_sink = pipe_id
-
-        self.pipes[pipe_id]['sink'] = true_sink  # Either specified dataset or same as pipe id
-
-        # self.LOGGER.debug(f'Flow for "{pipe_id}" is: "{self.pipes[pipe_id]}"')
+        self.graph.add_pipe_flow(pipe_conf['_id'], pipe_flow(pipe_conf))
 
     def pipe_flow_from_conf(self):
-        self.pipes = {}
+        self.graph.clear_pipe_flows()
         for entity in self.conf:
-            if recursive_getter("type") == 'Pipe':
+            if recursive_getter(entity, 'source.type') is not None:
                 self.add_pipe_flow(entity)
 
     def get_pipe_conf(self, _id: str):
-        for conf in self.conf:
-            if conf['_id'] == _id:
-                return conf
+        return self.graph.get_conf(_id)
 
     def get_pipe_with_source(self, _id: str):
-        for p in self.pipes:
-            if 'source' in self.pipes[p]:
-                if _id in self.pipes[p]['source']:
-                    return p
+        consumers = self.graph.get_consumers(_id)
+        if len(consumers) != 0:
+            return consumers[0]
         return None
-
-def recursive_getter(entity, key_str):
-    keys = key_str.split('.')
-    len_keys = len(keys)
-
-    def iter_recursive_getter(cur_entity, index=0):
-        if index == len_keys:
-            return cur_entity
-        elif keys[index] in cur_entity:
-            return iter_recursive_getter(cur_entity[keys[index]], index + 1)
-        else:
-            return None
-
-    return iter_recursive_getter(entity)
@@ -1,50 +1,167 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit
+from threading import Lock
+from time import monotonic, perf_counter
 
 from hvac import Client
 from hvac.exceptions import InvalidPath
-from sesamutils import sesam_logger
+from requests import Session
+from requests.adapters import HTTPAdapter
+from logger import get_logger
+
+from metrics import METRICS
 
 
 class Vaulter:
-    def __init__(self, url, token, mount_point, vault_path_prefix="",auth_type="git-token"):
-        self.LOGGER = sesam_logger('KeyVault')
-        self.client = Client(url=url)
+    def __init__(self, url, token, mount_point, vault_path_prefix="",auth_type="git-token", max_workers=8,
+                 cache_ttl=300, cache_size=10000, clock=monotonic):
+        self.LOGGER = get_logger('KeyVault')
+        self.max_workers = max_workers
+        # Secrets read from vault, including known missing paths. Only kept in memory, never written to disk.
+        self.cache = OrderedDict()  # {<path>: (<expires at>, <value>, <missing>)}
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock  # Seconds, only compared with each other
+        self.path_locks = {}  # {<path>: Lock}, so concurrent reads of the same path go to vault once
+        # One connection per worker, reused for every secret read.
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.client = Client(url=url, session=session)
+        self.url = url
+        self.token = token
+        self.auth_type = auth_type
         self.mount_point = mount_point
-        if auth_type == "git-token":
-            self.client.auth.github.login(token)
-        elif auth_type == "approle":
-            self.client.auth.approle.login(token)
+        self.login()
         self.missing_secrets = []
+        self.latencies = []  # Seconds spent on each secret read
+        self.cache_hits = 0
+        self.lock = Lock()
         self.vault_path_prefix = vault_path_prefix
         if not self.client.is_authenticated():
             self.LOGGER.critical(f'Cannot authenticate vault {url}. Exiting.')
             exit(-1)
 
+    def login(self):
+        if self.auth_type == "git-token":
+            self.client.auth.github.login(self.token)
+        elif self.auth_type == "approle":
+            self.client.auth.approle.login(self.token)
+
+    def ensure_authenticated(self):
+        """
+        I log in again if the vault token has expired, e.g. between runs in watch mode. I exit if that fails.
+        """
+        if self.client.is_authenticated():
+            return
+        self.LOGGER.info(f'Vault token for {self.url} expired, logging in again.')
+        self.login()
+        if not self.client.is_authenticated():
+            self.LOGGER.critical(f'Cannot authenticate vault {self.url}. Exiting.')
+            exit(-1)
+
     def get_secret(self, secret):
+        path = f'{self.vault_path_prefix}{secret}'
+        with self.lock:
+            path_lock = self.path_locks.setdefault(path, Lock())
+        with path_lock:
+            cached = self.get_cached(path)
+            if cached is None:
+                cached = self.read_secret(path)
+                self.put_cached(path, *cached)
+        return_value, missing = cached
+        with self.lock:
+            if missing and secret not in self.missing_secrets:
+                self.missing_secrets.append(secret)
+            elif not missing and secret in self.missing_secrets:
+                self.missing_secrets.remove(secret)  # Added to vault since it was last read
+        return return_value
+
+    def read_secret(self, path):
+        """
+        I return (<value>, <missing>) for a path in vault.
+        """
         return_value = None
+        missing = False
+        start = perf_counter()
         try:
             response = self.client.secrets.kv.v2.read_secret_version(
                 mount_point=self.mount_point,
-                path=f'{self.vault_path_prefix}{secret}'
+                path=path
             )
             key_value = response['data']['data']
             for k in key_value:
                 return_value = key_value[k]
                 break
         except InvalidPath as e:
-            self.missing_secrets.append(secret)
-        return return_value
+            missing = True
+        finally:
+            seconds = perf_counter() - start
+            with self.lock:
+                self.latencies.append(seconds)
+            METRICS.observe('vault_read', seconds)
+        METRICS.count('vault_reads', result='missing' if missing else 'found')
+        return return_value, missing
+
+    def get_cached(self, path):
+        with self.lock:
+            if path not in self.cache:
+                return None
+            expires_at, value, missing = self.cache[path]
+            if expires_at < self.clock():
+                del self.cache[path]
+                return None
+            self.cache.move_to_end(path)
+            self.cache_hits += 1
+            METRICS.count('vault_cache_hits')
+            return value, missing
+
+    def put_cached(self, path, value, missing):
+        with self.lock:
+            self.cache[path] = (self.clock() + self.cache_ttl, value, missing)
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.cache_size:
+                evicted_path, _ = self.cache.popitem(last=False)
+                self.path_locks.pop(evicted_path, None)
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
 
     def get_secrets(self, secrets):
-        output = {}
-        for s in secrets:
-            output[s] = self.get_secret(s)
-        return output
+        unique_secrets = list(dict.fromkeys(secrets))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            values = list(executor.map(self.get_secret, unique_secrets))
+        self.LOGGER.info(self.get_latency_summary())
+        return dict(zip(unique_secrets, values))
+
+    def reset_latencies(self):
+        with self.lock:
+            self.latencies = []
+            self.cache_hits = 0
+
+    def get_latency_summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return f'No secrets read from vault. Cache hits: {self.cache_hits}'
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return f'Read {len(latencies)} secrets from vault. Total: {sum(latencies):.2f}s, ' \
+               f'p50: {p50 * 1000:.0f}ms, p95: {p95 * 1000:.0f}ms, max: {latencies[-1] * 1000:.0f}ms. ' \
+               f'Cache hits: {self.cache_hits}'
 
-    def verify(self):
-        if len(self.missing_secrets) != 0:
+    def verify(self, secrets=None):
+        if len(self.get_missing_secrets(secrets)) != 0:
             return False
         return True
 
-    def get_missing_secrets(self):
-        return self.missing_secrets
+    def get_missing_secrets(self, secrets=None):
+        """
+        I return the missing secrets among secrets, or every missing secret read so far if secrets is None.
+        """
+        if secrets is None:
+            return self.missing_secrets
+        return [s for s in dict.fromkeys(secrets) if s in self.missing_secrets]
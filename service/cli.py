@@ -0,0 +1,48 @@
+from argparse import ArgumentParser
+from os import environ
+from sys import exit
+
+import deployer
+
+COMMAND_HELP = {
+    'verify': 'Read the node config and verify its variables and secrets. Talks to no node and pushes nothing.',
+    'generate-extra': 'Generate, verify and push the config of the extra nodes.',
+    'diff': 'Verify the config and diff it against every MASTER_NODE target, without deploying.',
+    'deploy': 'Generate the extra nodes, verify, diff and deploy. The same as running deployer.py.',
+    'watch': 'Run a command, then run it again every time files in NODE_FOLDER change, until stopped.'
+}
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(prog='cli.py', description='Verify, diff and deploy Sesam node config. '
+                                                       'Settings are read from the environment, see README.md.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in deployer.COMMANDS + ['watch']:
+        subparser = subparsers.add_parser(command, help=COMMAND_HELP[command], description=COMMAND_HELP[command])
+        subparser.add_argument('--dry-run', action='store_true', help='Set DRY_RUN=true: push and deploy nothing')
+        if command == 'watch':
+            subparser.add_argument('--run', default='deploy', choices=deployer.COMMANDS,
+                                   help='The command to run on every change. Defaults to deploy')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.dry_run:
+        environ['DRY_RUN'] = 'true'
+    command = args.run if args.command == 'watch' else args.command
+    deployer.load_config(require_master_node=command in ['diff', 'deploy'])
+    if args.command == 'watch':
+        try:
+            deployer.watch(command)
+        except KeyboardInterrupt:
+            exit(0)
+    try:
+        deployer.main(command)
+    finally:
+        deployer.write_run_report()  # Also for failed runs, which exit from deep inside main
+    exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,181 @@
-from json import loads as load_json, dumps as dump_json
-from os import listdir
-from re import sub
+from os import listdir, path as os_path, stat
+from re import compile as regex_compile
+from sys import exit
+from threading import Lock
 
 from Node import Node
-from dotty_dict import dotty
+from json_backend import load_json
 from sesamutils import sesam_logger
+from template_engine import CompiledTemplate, TemplateParents, compile_template
 
 LOGGER = sesam_logger('config-creator')
 
 
-class ConfigTemplates:
-    def __init__(self, path):
-        self.pipe_on_extra_from_extra_to_master = None
-        self.pipe_on_extra_from_master_to_extra = None
-        self.system_on_extra_from_extra_to_master = None
-        self.system_on_extra_from_master_to_extra = None
+TEMPLATE_ROLES = [
+    'pipe_on_extra_from_extra_to_master',
+    'pipe_on_extra_from_master_to_extra',
+    'system_on_extra_from_extra_to_master',
+    'system_on_extra_from_master_to_extra',
+    'pipe_on_master_from_extra_to_master',
+    'pipe_on_master_from_master_to_extra',
+    'system_on_master_from_extra_to_master',
+    'system_on_master_from_master_to_extra'
+]
+# <role>.json or <role>.<custom name>.json, where the custom file is rendered together with the role's own file.
+TEMPLATE_FILE_REGEX = regex_compile(r'^(' + '|'.join(TEMPLATE_ROLES) + r')(?:\.([\w-]+))?\.json$')
+NODE_METADATA_FILE = 'node-metadata.conf.json'
+
 
-        self.pipe_on_master_from_extra_to_master = None
-        self.pipe_on_master_from_master_to_extra = None
-        self.system_on_master_from_extra_to_master = None
-        self.system_on_master_from_master_to_extra = None
+class ConfigTemplates:
+    """
+    I load and validate all templates in a template directory once.
+    Besides the file for each role, a role can have custom templates named <role>.<custom name>.json.
+    """
 
+    def __init__(self, path):
+        self.path = path
         self.node_metadata = None
+        self.files = {role: [] for role in TEMPLATE_ROLES}  # {<role>: [(<filename>, <compiled file>), ...]}
+        self.errors = []  # Errors found while loading and validating templates
         self.get_templates(path)
+        self.validate()
 
     def get_templates(self, path):
-        for f in listdir(path):
-            if f == 'node-metadata.conf.json':
+        found = {role: [] for role in TEMPLATE_ROLES}
+        for f in sorted(listdir(path)):
+            if f == NODE_METADATA_FILE:
                 self.node_metadata = load_json(open(f'{path}{f}', 'r').read())
+                continue
+            match = TEMPLATE_FILE_REGEX.match(f)
+            if match is None:
+                if f.endswith('.json'):
+                    LOGGER.warning(f'Ignoring "{f}" in "{path}" because it is not named after a template role.')
+                continue
+            found[match.group(1)].append((match.group(2) or '', f))
+        for role in TEMPLATE_ROLES:
+            for custom_name, f in sorted(found[role]):  # The role's own file first, then custom files by name
+                self.files[role].append((f, load_template(path, f)))
+
+    def get_files(self, role):
+        """
+        I return the compiled template files for a role. Each is a compiled template or a list of them.
+        """
+        return [compiled_file for f, compiled_file in self.files[role]]
+
+    def get(self, role):
+        """
+        I return every compiled template for a role.
+        """
+        return [template for compiled_file in self.get_files(role) for template in as_list(compiled_file)]
+
+    def validate(self):
+        if self.node_metadata is None:
+            self.errors.append(f'Missing template {NODE_METADATA_FILE} in "{self.path}"')
+        missing_roles = [role for role in TEMPLATE_ROLES if len(self.files[role]) == 0]
+        if len(missing_roles) != 0:
+            LOGGER.info(f'No templates in "{self.path}" for: {missing_roles}')
+        for role in TEMPLATE_ROLES:
+            for template in self.get(role):
+                self.errors.extend(template.errors)
+                self.errors.extend(validate_template(role, template))
+
+
+class TemplateRegistry:
+    """
+    I cache ConfigTemplates by template directory, so extra nodes sharing a directory only load it once.
+    A directory is loaded again if it or any file in it has been modified.
+    """
+
+    def __init__(self):
+        self.templates = {}  # {<absolute path>: (<modification signature>, ConfigTemplates)}
+        self.lock = Lock()
+
+    def get(self, path):
+        key = os_path.abspath(path)
+        signature = modification_signature(path)
+        with self.lock:
+            if key not in self.templates or self.templates[key][0] != signature:
+                self.templates[key] = (signature, ConfigTemplates(path))
+            return self.templates[key][1]
 
-            # Extra pipes
-            if f == 'pipe_on_extra_from_extra_to_master.json':
-                self.pipe_on_extra_from_extra_to_master = load_json(open(f'{path}{f}', 'r').read())
-            if f == 'pipe_on_extra_from_master_to_extra.json':
-                self.pipe_on_extra_from_master_to_extra = load_json(open(f'{path}{f}', 'r').read())
-            # Extra systems
-            if f == 'system_on_extra_from_extra_to_master.json':
-                self.system_on_extra_from_extra_to_master = load_json(open(f'{path}{f}', 'r').read())
-            if f == 'system_on_extra_from_master_to_extra.json':
-                self.system_on_extra_from_master_to_extra = load_json(open(f'{path}{f}', 'r').read())
-
-            # Master pipes
-            if f == 'pipe_on_master_from_extra_to_master.json':
-                self.pipe_on_master_from_extra_to_master = load_json(open(f'{path}{f}', 'r').read())
-            if f == 'pipe_on_master_from_master_to_extra.json':
-                self.pipe_on_master_from_master_to_extra = load_json(open(f'{path}{f}', 'r').read())
-            # Master systems
-            if f == 'system_on_master_from_extra_to_master.json':
-                self.system_on_master_from_extra_to_master = load_json(open(f'{path}{f}', 'r').read())
-            if f == 'system_on_master_from_master_to_extra.json':
-                self.system_on_master_from_master_to_extra = load_json(open(f'{path}{f}', 'r').read())
-
-
-def generate_config(master_node: Node, extra_node: Node, template_path):
-    templates = ConfigTemplates(template_path)
-    from_extra_to_master(master_node, extra_node, templates)
-    from_master_to_extra(master_node, extra_node, templates)
-    extra_node.conf.append(templates.node_metadata)
+
+TEMPLATE_REGISTRY = TemplateRegistry()
+
+
+def modification_signature(path):
+    files = sorted(listdir(path))
+    return stat(path).st_mtime_ns, tuple((f, stat(f'{path}/{f}').st_mtime_ns) for f in files)
+
+
+def validate_template(role, template: CompiledTemplate):
+    errors = []
+    what = role.split('_')[0]
+    conf = template.template
+    if type(conf) is not dict:
+        return [f'Template {template.name} for {role} must contain a config or a list of configs']
+    for key in ['_id', 'type']:
+        if key not in conf:
+            errors.append(f'Template {template.name} is missing "{key}"')
+    if 'type' in conf and not str(conf['type']).startswith(what):
+        errors.append(f'Template {template.name} for {role} has type "{conf["type"]}", expected {what}')
+    if what == 'system':
+        for kind, key in template.slots:
+            if kind != 'REPLACE_ID':
+                errors.append(f'System template {template.name} can not use ##{kind}.{key}##, only ##REPLACE_ID##')
+    return errors
+
+
+def load_template(path, filename):
+    return compile_template(load_json(open(f'{path}{filename}', 'r').read()), name=filename)
+
+
+def generate_config(master_node: Node, extra_node: Node, template_path, master_conf: list = None):
+    """
+    I add the generated config for the extra node to it. Generated config for the master node is appended to
+    master_conf if given, so extra nodes can be generated concurrently and merged with merge_master_conf afterwards.
+    Otherwise it is merged into the master node right away.
+    """
+    merge_into_master = master_conf is None
+    if merge_into_master:
+        master_conf = []
+    templates = TEMPLATE_REGISTRY.get(template_path)
+    errors = list(templates.errors)
+    from_extra_to_master(master_node, extra_node, templates, master_conf, errors)
+    from_master_to_extra(master_node, extra_node, templates, master_conf, errors)
+    if len(errors) != 0:
+        for error in errors:
+            LOGGER.error(error)
+        LOGGER.critical(f'Found {len(errors)} template errors for extra node {extra_node.name}. Exiting.')
+        exit(-1)
+    extra_node.add_conf(templates.node_metadata)  # Not None here, a missing metadata template is an error above
+    if merge_into_master:
+        merge_master_conf(master_node, [(extra_node.name, master_conf)])
+    return master_conf
+
+
+def merge_master_conf(master_node: Node, contributions: list):
+    """
+    I add generated master config from each extra node, [(<extra node name>, [<conf>, ...]), ...], in the given order.
+    Config with the same _id as existing config is skipped if equal and a conflict if not.
+    """
+    conflicts = []
+    added_by = {}
+    for extra_node_name, master_conf in contributions:
+        for conf in master_conf:
+            existing = master_node.get_pipe_conf(conf['_id'])
+            if existing is None:
+                master_node.add_conf(conf)
+                added_by[conf['_id']] = extra_node_name
+            elif existing == conf:
+                LOGGER.debug(f'Skipping "{conf["_id"]}" from extra node {extra_node_name}, it is already in master.')
+            else:
+                conflicts.append(f'"{conf["_id"]}" from extra node {extra_node_name} conflicts with config from '
+                                 f'{added_by.get(conf["_id"], "master")}')
+    if len(conflicts) != 0:
+        for conflict in conflicts:
+            LOGGER.error(conflict)
+        LOGGER.critical(f'Found {len(conflicts)} conflicts in generated master config. Exiting.')
+        exit(-1)
 
 
 def get_vars_from_master(master_node: Node, extra_node: Node):
@@ -69,20 +188,18 @@ def get_vars_from_master(master_node: Node, extra_node: Node):
 def get_output_pipes_on_extra(master_node: Node, extra_node: Node):
     output = []
     for outgoing_pipe in a_writes_to_b(master_node, extra_node):
-        for endpoint in extra_node.pipes:
-            if 'source' in extra_node.pipes[endpoint]:
-                if outgoing_pipe in extra_node.pipes[endpoint]['source']:
-                    LOGGER.debug(f'Changing source for endpoint {endpoint} to binary from {outgoing_pipe}')
-                    output.append((endpoint, outgoing_pipe))
+        for endpoint in extra_node.graph.get_consumers(outgoing_pipe):
+            LOGGER.debug(f'Changing source for endpoint {endpoint} to binary from {outgoing_pipe}')
+            output.append((endpoint, outgoing_pipe))
     return output
 
 
-def from_extra_to_master(master_node: Node, extra_node: Node, templates: ConfigTemplates):
+def from_extra_to_master(master_node: Node, extra_node: Node, templates: ConfigTemplates, master_conf: list,
+                         errors: list):
     pipes = None
     if extra_node.proxy_node:
-        pipes = [pipe for pipe in extra_node.pipes if pipe not in [endpoint
-                                                                   for endpoint, outgoing in
-                                                                   get_output_pipes_on_extra(master_node, extra_node)]]
+        endpoints = {endpoint for endpoint, outgoing in get_output_pipes_on_extra(master_node, extra_node)}
+        pipes = [pipe for pipe in extra_node.pipes if pipe not in endpoints]
     else:
         pipes = a_writes_to_b(extra_node, master_node)
 
@@ -92,56 +209,34 @@ def from_extra_to_master(master_node: Node, extra_node: Node, templates: ConfigT
         outbound_pipe_name = master_node.get_pipe_with_source(p)
         if outbound_pipe_name:
             outbound_parent_pipe = master_node.get_pipe_conf(outbound_pipe_name)
+        parents = TemplateParents(inbound_parent_pipe, outbound_parent_pipe)
 
-        master_template = templates.pipe_on_master_from_extra_to_master
-        if master_template is not None:
-            if type(master_template) is list:
-                for m_template in master_template:
-                    stringed_template = dump_json(m_template)
-                    replaced_string_template = fill_template(stringed_template, inbound_parent_pipe,
-                                                             outbound_parent_pipe)
-                    jsoned_replaced_string_template = load_json(replaced_string_template)
-                    master_node.conf.append(jsoned_replaced_string_template)
-
-            else:
-                stringed_template = dump_json(master_template)
-                replaced_string_template = fill_template(stringed_template, inbound_parent_pipe, outbound_parent_pipe)
-                jsoned_replaced_string_template = load_json(replaced_string_template)
-                master_node.conf.append(jsoned_replaced_string_template)
-
+        master_templates = templates.get('pipe_on_master_from_extra_to_master')
+        if len(master_templates) != 0:
+            for m_template in master_templates:
+                master_conf.append(m_template.render(parents.pipe_id, parents, errors))
         else:
             LOGGER.warning('Missing template pipe_on_master_from_extra_to_master')
 
-        extra_template = templates.pipe_on_extra_from_extra_to_master
-        if extra_template is not None:
-            if type(extra_template) is list:
-                for x_template in extra_template:
-                    stringed_template = dump_json(x_template)
-                    replaced_string_template = fill_template(stringed_template, inbound_parent_pipe,
-                                                             outbound_parent_pipe)
-                    jsoned_replaced_string_template = load_json(replaced_string_template)
-                    extra_node.conf.append(jsoned_replaced_string_template)
-
-            else:
-                stringed_template = dump_json(extra_template)
-                replaced_string_template = fill_template(stringed_template, inbound_parent_pipe, outbound_parent_pipe)
-                jsoned_replaced_string_template = load_json(replaced_string_template)
-                extra_node.conf.append(jsoned_replaced_string_template)
-
+        extra_templates = templates.get('pipe_on_extra_from_extra_to_master')
+        if len(extra_templates) != 0:
+            for x_template in extra_templates:
+                extra_node.add_conf(x_template.render(parents.pipe_id, parents, errors))
         else:
             LOGGER.warning('Missing template pipe_on_extra_from_extra_to_master.')
 
-    extra_systems = [templates.system_on_extra_from_extra_to_master, templates.system_on_extra_from_master_to_extra]
+    extra_systems = templates.get_files('system_on_extra_from_extra_to_master') + \
+        templates.get_files('system_on_extra_from_master_to_extra')
     for e_s in extra_systems:
-        if e_s is not None:
-            if type(e_s) is list:
-                for sys in e_s:
-                    master_node.conf.append(load_json(dump_json(sys).replace('##REPLACE_ID##', extra_node.name)))
-            else:
-                extra_node.conf.append(load_json(dump_json(e_s).replace('##REPLACE_ID##', master_node.name)))
+        if type(e_s) is list:
+            for sys in e_s:
+                master_conf.append(sys.render(extra_node.name))
+        else:
+            extra_node.add_conf(e_s.render(master_node.name))
 
 
-def from_master_to_extra(master_node: Node, extra_node: Node, templates: ConfigTemplates):
+def from_master_to_extra(master_node: Node, extra_node: Node, templates: ConfigTemplates, master_conf: list,
+                         errors: list):
     pipes = a_writes_to_b(master_node, extra_node)
     for p in pipes:
 
@@ -150,104 +245,39 @@ def from_master_to_extra(master_node: Node, extra_node: Node, templates: ConfigT
         outbound_pipe_name = extra_node.get_pipe_with_source(p)
         if outbound_pipe_name:
             outbound_parent_pipe = extra_node.get_pipe_conf(outbound_pipe_name)
+        parents = TemplateParents(inbound_parent_pipe, outbound_parent_pipe)
 
-        master_template = templates.pipe_on_master_from_master_to_extra
+        master_templates = templates.get('pipe_on_master_from_master_to_extra')
         if not extra_node.proxy_node:
-            if master_template is not None:
-                if type(master_template) is list:
-                    for m_template in master_template:
-                        stringed_template = dump_json(m_template)
-                        replaced_string_template = fill_template(stringed_template, inbound_parent_pipe,
-                                                                 outbound_parent_pipe)
-                        jsoned_replaced_string_template = load_json(replaced_string_template)
-                        master_node.conf.append(jsoned_replaced_string_template)
-
-                else:
-                    stringed_template = dump_json(master_template)
-                    replaced_string_template = fill_template(stringed_template, inbound_parent_pipe,
-                                                             outbound_parent_pipe)
-                    jsoned_replaced_string_template = load_json(replaced_string_template)
-                    master_node.conf.append(jsoned_replaced_string_template)
-
+            if len(master_templates) != 0:
+                for m_template in master_templates:
+                    master_conf.append(m_template.render(parents.pipe_id, parents, errors))
             else:
                 LOGGER.warning('Missing template pipe_on_master_from_master_to_extra')
 
-        extra_template = templates.pipe_on_extra_from_master_to_extra
-        if extra_template is not None:
-            if type(extra_template) is list:
-                for ex_template in extra_template:
-                    stringed_template = dump_json(ex_template)
-                    replaced_string_template = fill_template(stringed_template, inbound_parent_pipe,
-                                                             outbound_parent_pipe)
-                    jsoned_replaced_string_template = load_json(replaced_string_template)
-                    extra_node.conf.append(jsoned_replaced_string_template)
-
-            else:
-                stringed_template = dump_json(extra_template)
-                replaced_string_template = fill_template(stringed_template, inbound_parent_pipe, outbound_parent_pipe)
-                jsoned_replaced_string_template = load_json(replaced_string_template)
-                extra_node.conf.append(jsoned_replaced_string_template)
-
+        extra_templates = templates.get('pipe_on_extra_from_master_to_extra')
+        if len(extra_templates) != 0:
+            for ex_template in extra_templates:
+                extra_node.add_conf(ex_template.render(parents.pipe_id, parents, errors))
         else:
             LOGGER.warning('Missing template pipe_on_extra_from_master_to_extra')
     if not extra_node.proxy_node:
-        master_systems = [templates.system_on_master_from_master_to_extra,
-                          templates.system_on_master_from_extra_to_master]
-        for m_s in master_systems:
-            if m_s is not None:
-                if type(m_s) is list:
-                    for sys in m_s:
-                        master_node.conf.append(load_json(dump_json(sys).replace('##REPLACE_ID##', extra_node.name)))
-                else:
-                    master_node.conf.append(load_json(dump_json(m_s).replace('##REPLACE_ID##', extra_node.name)))
-
-
-def fill_template(template: str, inbound_parent_pipe: dict, outbound_parent_pipe: dict):
+        master_systems = templates.get('system_on_master_from_master_to_extra') + \
+            templates.get('system_on_master_from_extra_to_master')
+        for sys in master_systems:
+            master_conf.append(sys.render(extra_node.name))
+
+
+def as_list(template):
     """
-    I take a template and replace the strings present.
-    I replace both the ##REPLACE_ID## with the parent pipe name and ##PARENT_PIPE.<key>## with values from parent.
-    return: str
+    I return a compiled template file as a list of compiled templates. Missing templates give an empty list.
     """
-    regex_inbound = r"#{2}INBOUND_PARENT_PIPE\.(.*?)#{2}"
-    regex_outbound = r"#{2}OUTBOUND_PARENT_PIPE\.(.*?)#{2}"
-    regex_replace_id = r'#{2}(REPLACE_ID)#{2}'
-
-    dotted_parent_inbound = dotty(inbound_parent_pipe)
-    dotted_parent_outbound = dotty(outbound_parent_pipe)
-    pipe_id = dotted_parent_inbound['_id']
-
-    def replace_matched_strings_from_inbound(matched_string):
-        """matched_string is of type re.Match"""
-        try:
-            output = dotted_parent_inbound[matched_string.group(1)]
-            return output
-        except KeyError as e:
-            LOGGER.error(f'Could not find keys: {matched_string.group(1)} in parent pipe: {pipe_id}.\nError: {e}')
-            exit(-1)
-
-    def replace_matched_strings_from_outbound(matched_string):
-        """matched_string is of type re.Match"""
-        try:
-            output = dotted_parent_outbound[matched_string.group(1)]
-            return output
-        except KeyError as e:
-            LOGGER.error(f'Could not find keys: {matched_string.group(1)} in parent pipe: {pipe_id}.\nError: {e}')
-            exit(-1)
-
-    template_replaced_id = sub(pattern=regex_replace_id, repl=pipe_id, string=template)
-    inbound_template = sub(pattern=regex_inbound, repl=replace_matched_strings_from_inbound,
-                           string=template_replaced_id)
-    outbound_template = sub(pattern=regex_outbound, repl=replace_matched_strings_from_outbound,
-                            string=inbound_template)
-    return outbound_template
+    if template is None:
+        return []
+    if type(template) is list:
+        return template
+    return [template]
 
 
 def a_writes_to_b(a, b):
-    output = []
-    for a_pipe in a.pipes:
-        for b_pipe in b.pipes:
-            if 'source' in b.pipes[b_pipe]:
-                if a.pipes[a_pipe]['sink'] in b.pipes[b_pipe]['source']:
-                    output.append(a_pipe)
-                    break
-    return output
+    return [a_pipe for a_pipe in a.pipes if len(b.graph.get_consumers(a.pipes[a_pipe]['sink'])) != 0]
@@ -0,0 +1,78 @@
+from hashlib import sha256
+
+from json_backend import dump_json_compact
+
+MISSING = object()  # Old or new value of a path which is only on one side
+
+
+class ConfigDiff:
+    """
+    I am the difference between running and new node config, indexed by _id:
+    added and removed _ids, and for changed _ids the list of (<path>, <old value>, <new value>) which differ.
+    """
+
+    def __init__(self, running: dict, new: dict):
+        self.running = running  # {<_id>: <conf>}
+        self.new = new  # {<_id>: <conf>}
+        self.added = sorted(_id for _id in new if _id not in running)
+        self.removed = sorted(_id for _id in running if _id not in new)
+        self.changed = {}  # {<_id>: [(<path>, <old value>, <new value>), ...]}
+        for _id in sorted(_id for _id in new if _id in running):
+            if fingerprint(running[_id]) != fingerprint(new[_id]):
+                self.changed[_id] = diff_values(running[_id], new[_id])
+
+    def is_empty(self):
+        return len(self.added) == 0 and len(self.removed) == 0 and len(self.changed) == 0
+
+    def changed_paths(self, _id: str):
+        return [format_path(path) for path, old, new in self.changed[_id]]
+
+    def summary(self):
+        return f'{len(self.added)} added, {len(self.changed)} changed and {len(self.removed)} removed'
+
+
+def diff_configs(running_conf: list, new_conf: list):
+    return ConfigDiff(index_by_id(running_conf), index_by_id(new_conf))
+
+
+def index_by_id(conf: list):
+    index = {}
+    for c in conf:
+        index.setdefault(c['_id'], c)  # First one wins if an _id is repeated
+    return index
+
+
+def fingerprint(conf):
+    return sha256(dump_json_compact(conf, sort_keys=True)).digest()
+
+
+def diff_values(old, new, path=()):
+    """
+    I return [(<path>, <old value>, <new value>), ...] for every place old and new differ.
+    Paths are tuples of keys and list indexes.
+    """
+    if type(old) is dict and type(new) is dict:
+        changes = []
+        for key in list(old) + [k for k in new if k not in old]:
+            if key not in new:
+                changes.append((path + (key,), old[key], MISSING))
+            elif key not in old:
+                changes.append((path + (key,), MISSING, new[key]))
+            else:
+                changes.extend(diff_values(old[key], new[key], path + (key,)))
+        return changes
+    if type(old) is list and type(new) is list and len(old) == len(new):
+        changes = []
+        for index, (o, n) in enumerate(zip(old, new)):
+            changes.extend(diff_values(o, n, path + (index,)))
+        return changes
+    if old == new and type(old) is type(new):
+        return []
+    return [(path, old, new)]
+
+
+def format_path(path: tuple):
+    output = ''
+    for p in path:
+        output += f'[{p}]' if type(p) is int else f'.{p}' if output != '' else p
+    return output
@@ -0,0 +1,51 @@
+from json_backend import dump_json
+
+
+# Top level keys come in this order, the rest alphabetically after them.
+TOP_LEVEL_KEY_ORDER = ['_id', 'type', 'name', 'description', 'comment', 'source', 'transform', 'sink', 'pump',
+                       'metadata']
+
+
+def format_config(conf):
+    """
+    I return a config as canonical json, without asking a node to reformat it:
+    Keys in a stable order, two space indentation and Sesam shorthand normalized where it can be done without knowing
+    anything about the node.
+    """
+    return dump_json(canonical_config(conf), indent=2, ensure_ascii=False)
+
+
+def canonical_config(conf):
+    if type(conf) is not dict:
+        return canonical_value(conf)
+    conf = dict(conf)
+    if conf.get('type') == 'pipe':
+        normalize_pipe(conf)
+    return {k: canonical_value(conf[k]) for k in sorted(conf, key=top_level_key)}
+
+
+def normalize_pipe(pipe):
+    # A single transform is the same as a list with one transform.
+    if type(pipe.get('transform')) is dict:
+        pipe['transform'] = [pipe['transform']]
+    # Merge sources are "<dataset> <alias>", extra whitespace means nothing.
+    source = pipe.get('source')
+    if type(source) is dict and type(source.get('datasets')) is list:
+        source = dict(source)
+        source['datasets'] = [' '.join(d.split()) if type(d) is str else d for d in source['datasets']]
+        pipe['source'] = source
+
+
+def canonical_value(value):
+    if type(value) is dict:
+        # Nested objects get type first, like the node does, then the rest alphabetically.
+        return {k: canonical_value(value[k]) for k in sorted(value, key=lambda k: (k != 'type', k))}
+    if type(value) is list:
+        return [canonical_value(v) for v in value]
+    return value
+
+
+def top_level_key(key):
+    if key in TOP_LEVEL_KEY_ORDER:
+        return 0, TOP_LEVEL_KEY_ORDER.index(key), key
+    return 1, 0, key
@@ -0,0 +1,209 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import path as os_path
+from re import compile as regex_compile
+from threading import Lock
+
+from document_store import DocumentStore, deep_size
+from json_backend import load_json
+from parse_cache import ParseCache, content_hash
+from logger import get_logger
+
+ENV_REGEX = regex_compile(r'\$ENV\((\S*?)\)')
+SECRET_REGEX = regex_compile(r'\$SECRET\((\S*?)\)')
+STORE_REBUILD_MIN = 100  # Forgotten files before the store is rebuilt, however few files are loaded
+
+
+class ConfigLoader:
+    """
+    I read and parse every whitelisted file once, using a thread pool, and share the parsed files between all nodes.
+    Each Node filters the shared files by metadata.node instead of reading them from disk again.
+    Parsed files are kept compact in store and must not be changed.
+    """
+
+    def __init__(self, max_workers=None, cache: ParseCache = None, store: DocumentStore = None):
+        self.max_workers = max_workers  # None lets ThreadPoolExecutor pick a default based on cpu count
+        self.cache = cache
+        self.store = store if store is not None else DocumentStore()
+        self.files = {}  # {<file path>: <entry from read_config_file or None if missing>}
+        self.whitelists = {}  # {(<node path>, <whitelist path>): [<filename>, ...]}
+        self.forgotten = 0  # Files forgotten since the store was last rebuilt
+        self.lock = Lock()
+
+        self.LOGGER = get_logger('Config loader')
+
+    def load(self, node_path: str, whitelist_path: str):
+        """
+        I return [(<filename>, <entry>), ...] in whitelist order. Entry is None if the file is missing.
+        """
+        with self.lock:
+            key = (node_path, whitelist_path)
+            if key not in self.whitelists:
+                filenames = read_whitelist(whitelist_path)
+                paths = [f'{node_path}/{filename}' for filename in filenames]
+                to_read = [p for p in dict.fromkeys(paths) if p not in self.files]
+                if len(to_read) != 0:
+                    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                        for p, entry in zip(to_read, executor.map(self.read_config_file, to_read)):
+                            self.files[p] = entry
+                    self.LOGGER.debug(f'Read {len(to_read)} files from "{node_path}"')
+                self.whitelists[key] = filenames
+            return [(filename, self.files[f'{node_path}/{filename}']) for filename in self.whitelists[key]]
+
+    def forget(self, file_paths: list):
+        """
+        I drop the parsed files in file_paths and every whitelist, so they are read again on the next load.
+        Files which did not change stay parsed. The strings of forgotten files stay in the store, so once more files
+        are forgotten than are loaded, I move the loaded files to a new store and the old strings are freed.
+        """
+        forgotten = {os_path.normpath(p) for p in file_paths}
+        with self.lock:
+            files = {p: entry for p, entry in self.files.items() if os_path.normpath(p) not in forgotten}
+            self.forgotten += len(self.files) - len(files)
+            self.files = files
+            self.whitelists = {}
+            self.store.shared_ids = None
+            if self.forgotten > max(len(self.files), STORE_REBUILD_MIN):
+                self.rebuild_store()
+
+    def rebuild_store(self):
+        """
+        I copy the loaded files into a new store. Call me with the lock held.
+        """
+        self.LOGGER.debug(f'Rebuilding the document store after {self.forgotten} forgotten files')
+        self.store = DocumentStore()
+        for p, entry in self.files.items():
+            if entry is not None:
+                self.files[p] = dict(entry, conf=self.store.add(entry['conf']))
+                if self.cache is not None:
+                    self.cache.put(p, self.files[p])
+        self.forgotten = 0
+
+    def own_size(self, conf: list):
+        """
+        I return the bytes a node's config takes on its own, apart from the parsed files shared by all nodes.
+        """
+        with self.lock:
+            shared = [entry['conf'] for entry in self.files.values() if entry is not None]
+        return self.store.own_size(conf, shared)
+
+    def shared_size(self):
+        """
+        I return the bytes of the parsed files shared by all nodes, with the strings interned in the store.
+        """
+        with self.lock:
+            shared = [entry['conf'] for entry in self.files.values() if entry is not None]
+        return deep_size(shared)
+
+    def read_config_file(self, file_path: str):
+        """
+        I return {conf: dict, pipe_flow: dict or None, vars: list, secrets: list} for a config file.
+        """
+        try:
+            content = open(file_path, 'rb').read()
+        except FileNotFoundError:
+            return None
+        if self.cache is None:
+            return parse_config_file(content, self.store)
+        file_hash = content_hash(content)
+        entry = self.cache.get(file_path, file_hash)
+        if entry is None:
+            entry = parse_config_file(content, self.store)
+            entry['hash'] = file_hash
+        else:
+            entry = dict(entry, conf=self.store.add(entry['conf']))
+        self.cache.put(file_path, entry)  # The cache keeps the compact entry instead of the one it read
+        return entry
+
+
+def read_whitelist(whitelist_path: str):
+    return list(filter(lambda x: x != '', open(whitelist_path, 'r').read().split('\n')))
+
+
+def parse_config_file(content: bytes, store: DocumentStore):
+    dollar_strings = []
+    conf = store.add(load_json(content), dollar_strings)
+    config_vars, config_secrets = find_references_in_strings(dollar_strings)
+    return {
+        'conf': conf,
+        'pipe_flow': pipe_flow(conf) if recursive_getter(conf, 'source.type') is not None else None,
+        'vars': config_vars,
+        'secrets': config_secrets
+    }
+
+
+def find_references(conf):
+    """
+    I return the $ENV and $SECRET references in a config as two lists without duplicates.
+    I walk the config string by string instead of dumping it, so memory use does not grow with the config size.
+    """
+    dollar_strings = []
+    stack = [conf]
+    while len(stack) != 0:
+        cur = stack.pop()
+        if type(cur) is dict:
+            for key, value in reversed(list(cur.items())):
+                stack.extend((value, key))
+        elif type(cur) is list:
+            stack.extend(reversed(cur))
+        elif type(cur) is str and '$' in cur:
+            dollar_strings.append(cur)
+    return find_references_in_strings(dollar_strings)
+
+
+def find_references_in_strings(strings: list):
+    """
+    I return the $ENV and $SECRET references in strings as two lists without duplicates, in the order found.
+    """
+    config_vars = {}
+    config_secrets = {}
+    for s in strings:
+        config_vars.update(dict.fromkeys(ENV_REGEX.findall(s)))
+        config_secrets.update(dict.fromkeys(SECRET_REGEX.findall(s)))
+    return list(config_vars), list(config_secrets)
+
+
+def pipe_flow(pipe_conf):
+    """
+    I return {source: [str], sink: str} for a pipe. Source is left out if the pipe does not read from a dataset.
+    """
+    flow = {}
+
+    # Get pipe sources
+    source_type = recursive_getter(pipe_conf, 'source.type')
+    true_source = None
+    if source_type == 'dataset':
+        true_source = recursive_getter(pipe_conf, 'source.dataset')
+    elif source_type == 'merge':
+        true_source = recursive_getter(pipe_conf, 'source.datasets')
+
+    if true_source is not None:
+        if type(true_source) == list:
+            flow['source'] = [e.split(" ")[0] for e in true_source]
+        else:
+            flow['source'] = [true_source]
+
+    sink_type = recursive_getter(pipe_conf, 'sink.type')
+    true_sink = None
+    if sink_type is not None:
+        if sink_type == 'dataset':
+            true_sink = recursive_getter(pipe_conf, 'sink.dataset')
+    if true_sink is None:  # because pipe can have sink type dataset without specifying dataset name.
+        true_sink = pipe_conf['_id']
+
+    flow['sink'] = true_sink  # Either specified dataset or same as pipe id
+    return flow
+
+
+def recursive_getter(entity, key_str):
+    keys = key_str.split('.')
+    len_keys = len(keys)
+
+    def iter_recursive_getter(cur_entity, index=0):
+        if index == len_keys:
+            return cur_entity
+        elif keys[index] in cur_entity:
+            return iter_recursive_getter(cur_entity[keys[index]], index + 1)
+        else:
+            return None
+
+    return iter_recursive_getter(entity)
@@ -1,19 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from difflib import context_diff
-from json import loads as load_json, dumps as dump_json
 from os import getenv, listdir
+from re import sub as regex_sub
 from sys import exit
-from time import sleep
+from threading import Lock
+from time import perf_counter, sleep
+from typing import TYPE_CHECKING
+from urllib.parse import quote
 
-from requests import session as connection
 from sesamutils import sesam_logger
-from slack import WebClient
-from slack.errors import SlackApiError
 
-# Local imports
+# Local imports. slack, hvac, git and requests are imported where they are used, so a run only loads what it needs
 from Node import Node
-from Vaulter import Vaulter
-from config_creator import generate_config, get_vars_from_master
-from gitter import Gitter
+from config_diff import ConfigDiff, diff_configs, fingerprint
+from config_creator import generate_config, get_vars_from_master, merge_master_conf
+from config_loader import ConfigLoader
+from parse_cache import ParseCache
+from config_formatter import format_config
+from reformatter import Reformatter
+from json_backend import dump_json, load_json, use_backend
+from metrics import METRICS
+from watcher import FolderWatcher
+
+if TYPE_CHECKING:
+    from Vaulter import Vaulter
+    from node_client import NodeClient
 
 
 class AppConfig(object):
@@ -23,7 +34,6 @@ class AppConfig(object):
 config = AppConfig()
 
 LOGGER = sesam_logger('Autodeployer')
-LOGGER.debug(listdir())
 ENV_VARS = [
     ('NODE_FOLDER', str, None),
     ('ENVIRONMENT', str, None),
@@ -44,12 +54,41 @@ ENV_VARS = [
     ('VAULT_PATH_PREFIX', str, None),
     ('UPLOAD_VARIABLES_FROM_FILE', str, None),
     ('VERIFY_VARIABLES_FROM_FILES', list, None),
-    ('WHITELIST_FILE_PATH', str, None)
+    ('WHITELIST_FILE_PATH', str, None),
+    ('PARSE_CACHE_FILE', str, None),
+    ('EXTRA_NODE_WORKERS', int, None),
+    ('VAULT_WORKERS', int, None),
+    ('VAULT_CACHE_TTL', int, None),
+    ('VAULT_CACHE_SIZE', int, None),
+    ('GIT_MIRROR_FOLDER', str, None),
+    ('GIT_WORKTREELESS', bool, None),
+    ('REFORMAT_WORKERS', int, None),
+    ('REFORMAT_CACHE_FILE', str, None),
+    ('DIFF_MODE', str, None),
+    ('DEPLOY_MODE', str, None),
+    ('HTTP_CONNECT_TIMEOUT', int, None),
+    ('HTTP_READ_TIMEOUT', int, None),
+    ('HTTP_RETRIES', int, None),
+    ('HTTP_GZIP_MIN_SIZE', int, None),
+    ('HTTP_STREAM_CONFIG', bool, None),
+    ('TARGET_WORKERS', int, None),
+    ('JSON_BACKEND', str, None),
+    ('RUN_REPORT_FILE', str, None),
+    ('PROMETHEUS_TEXTFILE', str, None),
+    ('WATCH_INTERVAL', int, None),
+    ('WATCH_GIT_PULL', bool, None)
 ]
 
 OPTIONAL_ENV_VARS = ['EXTRA_NODES', 'SLACK_API_TOKEN', 'SLACK_CHANNEL', 'CONFIG_GROUP', 'RELEASE_URL',
                      'VAULT_PATH_PREFIX', 'VERIFY_VARIABLES_FROM_FILES','UPLOAD_VARIABLES_FROM_FILE',
-                     'WHITELIST_FILE_PATH', 'VAULT_GIT_TOKEN','VAULT_APPROLE_ID', 'VAULT_AUTH']
+                     'WHITELIST_FILE_PATH', 'VAULT_GIT_TOKEN','VAULT_APPROLE_ID', 'VAULT_AUTH', 'PARSE_CACHE_FILE',
+                     'EXTRA_NODE_WORKERS', 'VAULT_WORKERS',
+                     'VAULT_CACHE_TTL', 'VAULT_CACHE_SIZE', 'GIT_MIRROR_FOLDER', 'GIT_WORKTREELESS',
+                     'REFORMAT_WORKERS', 'REFORMAT_CACHE_FILE', 'DIFF_MODE',
+                     'DEPLOY_MODE', 'HTTP_CONNECT_TIMEOUT', 'HTTP_READ_TIMEOUT', 'HTTP_RETRIES',
+                     'HTTP_GZIP_MIN_SIZE', 'HTTP_STREAM_CONFIG', 'TARGET_WORKERS',
+                     'JSON_BACKEND', 'RUN_REPORT_FILE', 'PROMETHEUS_TEXTFILE',
+                     'WATCH_INTERVAL', 'WATCH_GIT_PULL']
 
 missing_vars = []
 
@@ -67,56 +106,92 @@ def recursive_set_env_var(triple_tuple_env_var):
                 setattr(config, var, curvar)
                 if curvar and child_required_vars is not None:
                     recursive_set_env_var(child_required_vars)
+            elif t == int:
+                setattr(config, var, int(curvar))
             elif t == list:
                 setattr(config, var, curvar.split(sep=';'))
             elif t == dict:
                 jsoned_curvar = load_json(curvar.replace('`', ''))
                 if child_required_vars is not None:
-                    for k in child_required_vars:
-                        if k not in jsoned_curvar:
-                            if k not in OPTIONAL_ENV_VARS:
-                                missing_vars.append(f'{var}->{k}')
-                        else:
-                            curtype = child_required_vars[k]
-                            if curtype == bool:
-                                jsoned_curvar[k] = jsoned_curvar[k].lower() == 'true'
+                    # MASTER_NODE can also be a list of targets, each checked like a single one
+                    for i, jsoned_item in enumerate(jsoned_curvar if type(jsoned_curvar) is list else [jsoned_curvar]):
+                        item_name = var if type(jsoned_curvar) is not list else f'{var}[{i}]'
+                        for k in child_required_vars:
+                            if k not in jsoned_item:
+                                if k not in OPTIONAL_ENV_VARS:
+                                    missing_vars.append(f'{item_name}->{k}')
+                            else:
+                                curtype = child_required_vars[k]
+                                if curtype == bool and type(jsoned_item[k]) is not bool:
+                                    jsoned_item[k] = jsoned_item[k].lower() == 'true'
                 setattr(config, var, jsoned_curvar)
             else:
                 setattr(config, var, curvar)
 
 
-recursive_set_env_var(ENV_VARS)
-
-env = getattr(config, 'ENVIRONMENT', '').lower()
-path = getattr(config, 'NODE_FOLDER', None)
 GIT_REPO_BASE_FOLDERS = 'GIT_REPOS'
-verify_variables = getattr(config, 'VERIFY_VARIABLES', None)
-verify_secrets = getattr(config, 'VERIFY_SECRETS', None)
-dry_run = getattr(config, 'DRY_RUN', None)
-
-if len(missing_vars) != 0:
-    if missing_vars == ['MASTER_NODE'] and dry_run and env == 'ci':
-        LOGGER.info('Only verifying config, not talking to any nodes.')
-        pass
-    else:
-        LOGGER.error(f'Missing variables: {missing_vars}\nExiting.')
-        exit(-1)
+# Set by load_config
+env = ''
+path = None
+verify_variables = None
+verify_secrets = None
+dry_run = None
+
+
+def load_config(require_master_node=True):
+    """
+    I read and check the environment variables into config. I exit if they are incomplete or invalid.
+    MASTER_NODE is only required if require_master_node, or it is a deploy which is not a ci dry run.
+    """
+    global env, path, verify_variables, verify_secrets, dry_run
+    LOGGER.debug(listdir())
+    missing_vars.clear()
+    recursive_set_env_var(ENV_VARS)
+
+    env = getattr(config, 'ENVIRONMENT', '').lower()
+    path = getattr(config, 'NODE_FOLDER', None)
+    verify_variables = getattr(config, 'VERIFY_VARIABLES', None)
+    verify_secrets = getattr(config, 'VERIFY_SECRETS', None)
+    dry_run = getattr(config, 'DRY_RUN', None)
+    if getattr(config, 'JSON_BACKEND', None) is not None:
+        try:
+            LOGGER.info(f'Using json backend "{use_backend(config.JSON_BACKEND)}"')
+        except ValueError as e:
+            LOGGER.error(f'{e}\nExiting.')
+            exit(-1)
+
+    if len(missing_vars) != 0:
+        if missing_vars == ['MASTER_NODE'] and (not require_master_node or (dry_run and env == 'ci')):
+            LOGGER.info('Only verifying config, not talking to any nodes.')
+        else:
+            LOGGER.error(f'Missing variables: {missing_vars}\nExiting.')
+            exit(-1)
+
+    if getattr(config, "VERIFY_SECRETS"):
+        if (getattr(config, 'VAULT_GIT_TOKEN', False)) or (getattr(config, 'VAULT_APPROLE_ID', False) and getattr(config, 'VAULT_AUTH', False) == "approle"):
+            pass
+        else:
+            LOGGER.error(f'When VERIFY_SECRETS=True, VAULT_GIT_TOKEN must be set or VAULT_APPROLE_ID must be set and VAULT_AUTH="approle"')
+            exit(-1)
 
-if getattr(config,"VERIFY_SECRETS"):
-    if (getattr(config, 'VAULT_GIT_TOKEN', False)) or  (getattr(config, 'VAULT_APPROLE_ID',False) and getattr(config, 'VAULT_AUTH',False)=="approle"):
-        pass
-    else:  
-        LOGGER.error(f'When VERIFY_SECRETS=True, VAULT_GIT_TOKEN must be set or VAULT_APPROLE_ID must be set and VAULT_AUTH="approle"')
-        exit(-1)
 
-RETRY_TIMER = 30
-RETRIES = 5
+NODE_CLIENTS = {}  # {(<url>, <jwt>): NodeClient}
+NODE_CLIENTS_LOCK = Lock()
+INCREMENTAL_TYPES = ['pipe', 'system']  # Component types with their own endpoints in the node API
+VAULT = {}  # {'vault': Vaulter or None}, so watch mode logs in to Vault once
+PUSHED_EXTRA_NODES = {}  # {<extra node>: <fingerprint of the config last pushed>}
 
 
-def send_slack_file(msg):
+def send_slack_file(msg, filepath=None):
+    """
+    I write msg to filepath, ./<env>-diff.txt by default, and upload it.
+    """
+    from slack import WebClient
+    from slack.errors import SlackApiError
     client = WebClient(token=getattr(config, 'SLACK_API_TOKEN', None))
     channel = config.SLACK_CHANNEL
-    filepath = f'./{env}-diff.txt'
+    if filepath is None:
+        filepath = f'./{env}-diff.txt'
     diff_file = open(filepath, 'w')
     diff_file.write(msg)
     diff_file.close()
@@ -135,6 +210,8 @@ def send_slack_file(msg):
 
 
 def send_slack_message(msg):
+    from slack import WebClient
+    from slack.errors import SlackApiError
     client = WebClient(token=getattr(config, 'SLACK_API_TOKEN', None))
     channel = config.SLACK_CHANNEL
     try:
@@ -149,86 +226,164 @@ def send_slack_message(msg):
 
 
 
-def do_put(ses, url, json, params=None):
+def api_url(url):
+    """
+    I return the api url of a node. URL is a host name like in MASTER_NODE, or starts with http:// or https://,
+    e.g. for a local stand-in of the node.
+    """
+    if url.startswith('http://') or url.startswith('https://'):
+        return f'{url.rstrip("/")}/api'
+    return f'https://{url}/api'
+
+
+def get_node_client(url, jwt):
+    """
+    I return the client for a node, so every request to it shares one connection pool.
+    """
+    from node_client import NodeClient
+    with NODE_CLIENTS_LOCK:
+        if (url, jwt) not in NODE_CLIENTS:
+            NODE_CLIENTS[(url, jwt)] = NodeClient(jwt,
+                                                  # A connection per reformat worker
+                                                  pool_maxsize=getattr(config, 'REFORMAT_WORKERS', 8),
+                                                  connect_timeout=getattr(config, 'HTTP_CONNECT_TIMEOUT', 10),
+                                                  read_timeout=getattr(config, 'HTTP_READ_TIMEOUT', 300),
+                                                  retries=getattr(config, 'HTTP_RETRIES', 5),
+                                                  gzip_min_size=getattr(config, 'HTTP_GZIP_MIN_SIZE', None))
+        return NODE_CLIENTS[(url, jwt)]
+
+
+def do_put(client: 'NodeClient', url, json, params=None, stream=False):
     try:
-        for tries in range(RETRIES):
-            request = ses.put(url=url, json=json, params=params)
-            if request.ok:
-                LOGGER.info(f'Succesfully PUT request to "{url}"')
-                return 0
-            else:
-                LOGGER.warning(
-                    f'Could not PUT request to url "{url}". Response:{request.content}. Try {tries} of {RETRIES}')
-                sleep(RETRY_TIMER)
-        LOGGER.critical(f'Each PUT request failed to "{url}".')
+        request = client.request('PUT', url=url, json=json, params=params, stream=stream)
+        if request.ok:
+            LOGGER.info(f'Succesfully PUT request to "{url}"')
+            return 0
+        LOGGER.critical(f'PUT request failed to "{url}". Response:{request.status_code} {request.content}')
         return -1
     except Exception as e:
         LOGGER.critical(f'Got exception "{e}" while doing PUT request to url "{url}"')
         return -2
 
 
-def do_get(ses, url, params=None):
+def do_get(client: 'NodeClient', url, params=None):
     try:
-        for tries in range(RETRIES):
-            request = ses.get(url=url, params=params)
-            if request.ok:
-                LOGGER.info(f'Successfully GOT request from "{url}"')
-                return load_json(request.content.decode('UTF-8'))
-            else:
-                LOGGER.warning(
-                    f'Could not GET request from url "{url}". Response:{request.content}. Try {tries} of {RETRIES}')
-                sleep(RETRY_TIMER)
-        LOGGER.critical(f'Each GET request failed to "{url}".')
+        request = client.request('GET', url=url, params=params)
+        if request.ok:
+            LOGGER.info(f'Successfully GOT request from "{url}"')
+            return load_json(request.content)
+        LOGGER.critical(f'GET request failed to "{url}". Response:{request.status_code} {request.content}')
     except Exception as e:
         LOGGER.critical(f'Got exception "{e}" while doing GET request to url "{url}"')
 
 
-def do_post(ses, url, json, params=None):
+def do_post(client: 'NodeClient', url, json, params=None):
     try:
-        for tries in range(RETRIES):
-            request = ses.post(url=url, json=json, params=params)
-            if request.ok:
-                LOGGER.info(f'Successful POST request to "{url}"')
-                return request.content.decode('UTF-8')
-            else:
-                LOGGER.warning(
-                    f'Could not POST request to url "{url}". Response:{request.content}. Try {tries} of {RETRIES}')
-                sleep(RETRY_TIMER)
-        LOGGER.critical(f'Each POST request failed to "{url}".')
+        request = client.request('POST', url=url, json=json, params=params)
+        if request.ok:
+            LOGGER.info(f'Successful POST request to "{url}"')
+            return request.content.decode('UTF-8')
+        LOGGER.critical(f'POST request failed to "{url}". Response:{request.status_code} {request.content}')
         return None
     except Exception as e:
         LOGGER.critical(f'Got exception "{e}" while doing POST request to url "{url}"')
         return None
 
 
-def deploy(url, jwt, upload_variables, upload_secrets, node: Node, config_group=None):
-    session = connection()
-    session.headers = {'Authorization': f'bearer {jwt}'}
+def do_delete(client: 'NodeClient', url, params=None):
+    try:
+        request = client.request('DELETE', url=url, params=params)
+        if request.ok or request.status_code == 404:  # Already gone is what we want
+            LOGGER.info(f'Successful DELETE request to "{url}"')
+            return 0
+        LOGGER.critical(f'DELETE request failed to "{url}". Response:{request.status_code} {request.content}')
+        return -1
+    except Exception as e:
+        LOGGER.critical(f'Got exception "{e}" while doing DELETE request to url "{url}"')
+        return -2
+
+
+def deploy_incremental(client: 'NodeClient', url, diff: ConfigDiff):
+    """
+    I deploy only the added, changed and removed pipes and systems in diff through the per component endpoints.
+    Systems are added before the pipes using them, and pipes are removed before the systems they use.
+    I return 0 if every request succeeded and a negative number otherwise.
+    """
+    component_types = {_id: conf['type'].split(':')[0]  # system:url, system:mssql, ... are all systems
+                       for confs in (diff.running, diff.new) for _id, conf in confs.items()}
+    unsupported = [_id for _id in diff.added + list(diff.changed) + diff.removed
+                   if component_types[_id] not in INCREMENTAL_TYPES]
+    if len(unsupported) != 0:
+        LOGGER.info(f'Can not deploy {unsupported} incrementally. Only pipes and systems are supported.')
+        return -1
+    for component_type in ['system', 'pipe']:
+        base_url = f'{api_url(url)}/{component_type}s'
+        added = [diff.new[_id] for _id in diff.added if component_types[_id] == component_type]
+        if len(added) != 0:
+            if do_post(client, base_url, json=added, params={'force': True}) is None:
+                return -2
+        for _id in [_id for _id in diff.changed if component_types[_id] == component_type]:
+            if do_put(client, f'{base_url}/{quote(_id, safe="")}/config', json=diff.new[_id],
+                      params={'force': True}) != 0:
+                return -3
+    for component_type in ['pipe', 'system']:
+        base_url = f'{api_url(url)}/{component_type}s'
+        for _id in [_id for _id in diff.removed if component_types[_id] == component_type]:
+            if do_delete(client, f'{base_url}/{quote(_id, safe="")}') != 0:
+                return -4
+    LOGGER.info(f'Deployed {diff.summary()} components incrementally.')
+    return 0
+
+
+def target_conf(node: Node, config_group=None):
+    """
+    I return the node config to deploy to a target. Node metadata is left out when deploying to a config group.
+    The node itself is not changed, so it can be deployed to several targets.
+    """
+    if config_group is None:
+        return node.conf
+    return [f for f in node.conf if f['type'] != 'metadata']
+
+
+def deploy(url, jwt, upload_variables, upload_secrets, node: Node, config_group=None, diff: ConfigDiff = None):
+    """
+    I upload secrets, variables and the node config, and return 0 or a negative exit code if a request failed.
+    With DEPLOY_MODE=incremental and a diff from do_diff, only the components in the diff are sent. If that is not
+    possible or fails, I fall back to a full PUT of the node config.
+    """
+    client = get_node_client(url, jwt)
+    incremental = getattr(config, 'DEPLOY_MODE', 'full') == 'incremental'
+    if incremental and diff is None:
+        LOGGER.info('No config diff available, deploying the full node config.')
+        incremental = False
+    elif incremental and config_group is not None:
+        LOGGER.info('Incremental deploy does not support CONFIG_GROUP, deploying the full node config.')
+        incremental = False
+    if config_group is not None and len(target_conf(node, config_group)) != len(node.conf):
+        LOGGER.warning('Removing node metadata from upload config because CONFIG_GROUP is set!')
+
+    if upload_secrets:
+        if do_put(client, f'{api_url(url)}/secrets', json=node.upload_secrets) != 0:  # Secrets
+            return -3
+    if upload_variables:
+        if do_put(client, f'{api_url(url)}/env', json=node.upload_vars) != 0:  # Environment variables
+            return -4
     if config_group is None:
-        if upload_secrets:
-            if do_put(session, f'https://{url}/api/secrets', json=node.upload_secrets) != 0:  # Secrets
-                exit(-3)
-        if upload_variables:
-            if do_put(session, f'https://{url}/api/env', json=node.upload_vars) != 0:  # Environment variables
-                exit(-4)
-        if do_put(session, f'https://{url}/api/config', json=node.conf,
-                  params={'force': True}) != 0:  # Node config
-            exit(-5)
+        if incremental:
+            if diff.is_empty():
+                LOGGER.info('Node config is unchanged, nothing to deploy.')
+                return 0
+            if deploy_incremental(client, url, diff) == 0:
+                return 0
+            LOGGER.warning('Incremental deploy failed, deploying the full node config.')
+        if do_put(client, f'{api_url(url)}/config', json=node.conf, params={'force': True},
+                  stream=getattr(config, 'HTTP_STREAM_CONFIG', False)) != 0:  # Node config
+            return -5
     else:
-        for f in node.conf:
-            if f['type'] == 'metadata':
-                node.conf.remove(f)
-                LOGGER.warning('Removing node metadata from upload config because CONFIG_GROUP is set!')
-
-        if upload_secrets:
-            if do_put(session, f'https://{url}/api/secrets', json=node.upload_secrets) != 0:  # Secrets
-                exit(-3)
-        if upload_variables:
-            if do_put(session, f'https://{url}/api/env', json=node.upload_vars) != 0:  # Environment variables
-                exit(-4)
-        if do_put(session, f'https://{url}/api/config/{config_group}', json=node.conf,
-                  params={'force': True}) != 0:  # Node config
-            exit(-6)
+        if do_put(client, f'{api_url(url)}/config/{config_group}', json=target_conf(node, config_group),
+                  params={'force': True}, stream=getattr(config, 'HTTP_STREAM_CONFIG', False)) != 0:  # Node config
+            return -6
+    return 0
 
 
 def do_context_diff(original, new, dump_as_json=False):
@@ -241,49 +396,40 @@ def do_context_diff(original, new, dump_as_json=False):
                                 'Original', 'New'))
 
 
-def a_not_in_b(a, b):
-    output = []
-    for af in a:
-        found_file = False
-        for bf in b:
-            if af['_id'] == bf['_id']:
-                found_file = True
-                break
-        if not found_file:
-            output.append(af['_id'])
-    return output
-
-
-def do_diff(url, jwt, node: Node, config_group=None):
-    session = connection()
-    session.headers = {'Authorization': f'bearer {jwt}'}
-    total_string = ''
+def do_diff(url, jwt, node: Node, config_group=None, diff_file=None):
+    client = get_node_client(url, jwt)
+    name = target_name({'URL': url, 'CONFIG_GROUP': config_group})
+    total_string = f'Target: {name}\n'
 
     # Do config diff
-    config_url = f'https://{url}/api/config'
+    config_url = f'{api_url(url)}/config'
     if config_group is not None:
         config_url += f'/{config_group}'
-    running_node_conf = sorted(do_get(session, config_url), key=lambda k: k['_id'])
-    new_node_config = sorted(node.conf, key=lambda k: k['_id'])
-
-
-    LOGGER.info('Running config diff!')
-    removed_files = []
-    new_files = a_not_in_b(new_node_config, running_node_conf)
-
-    for rf in running_node_conf:
-        found_file = False
-        for nf in new_node_config:
-            if nf['_id'] == rf['_id']:
-                found_file = True
-                if rf != nf:
-                    rf_formatted = do_post(session, url=f'https://{url}/api/utils/reformat-config', json=rf)
-                    nf_formatted = do_post(session, url=f'https://{url}/api/utils/reformat-config', json=nf)
-                    LOGGER.info(f'{nf["_id"]}\n{do_context_diff(rf_formatted, nf_formatted)}')
-                    total_string += f'{nf["_id"]}\n{do_context_diff(rf_formatted, nf_formatted)}\n'
-                break
-        if not found_file:
-            removed_files.append(rf['_id'])
+    running_node_conf = do_get(client, config_url)
+
+    LOGGER.info(f'Running config diff against "{config_url}"!')
+    diff = diff_configs(running_node_conf, target_conf(node, config_group))
+    LOGGER.info(f'Config diff: {diff.summary()}')
+    new_files = diff.added
+    removed_files = diff.removed
+    changed_files = [(diff.running[_id], diff.new[_id]) for _id in diff.changed]
+
+    to_format = [f for pair in changed_files for f in pair]
+    if getattr(config, 'DIFF_MODE', 'local') == 'remote':
+        reformatter = Reformatter(
+            lambda conf: do_post(client, url=f'{api_url(url)}/utils/reformat-config', json=conf),
+            max_workers=getattr(config, 'REFORMAT_WORKERS', 8),
+            cache_file=getattr(config, 'REFORMAT_CACHE_FILE', None),
+            namespace=url if config_group is None else f'{url}/{config_group}')
+        formatted = reformatter.reformat_all(to_format)
+        reformatter.write()
+    else:
+        formatted = [format_config(conf) for conf in to_format]
+    for i, (rf, nf) in enumerate(changed_files):
+        rf_formatted, nf_formatted = formatted[2 * i], formatted[2 * i + 1]
+        changed_paths = f'Changed: {", ".join(diff.changed_paths(nf["_id"]))}'
+        LOGGER.info(f'{nf["_id"]}\n{changed_paths}\n{do_context_diff(rf_formatted, nf_formatted)}')
+        total_string += f'{nf["_id"]}\n{changed_paths}\n{do_context_diff(rf_formatted, nf_formatted)}\n'
 
     LOGGER.info(f'New files!: {new_files}')
     LOGGER.info(f'Removed files!: {removed_files}')
@@ -292,125 +438,390 @@ def do_diff(url, jwt, node: Node, config_group=None):
 
     # Do variable diff
     if config_group is None:
-        running_node_vars = do_get(session, f'https://{url}/api/env')
+        running_node_vars = do_get(client, f'{api_url(url)}/env')
         new_node_vars = node.upload_vars
         LOGGER.info(f'Running variables diff!\n{do_context_diff(running_node_vars, new_node_vars, dump_as_json=True)}')
         total_string += f'Running variables diff!\n{do_context_diff(running_node_vars, new_node_vars, dump_as_json=True)}\n'
 
     if getattr(config, 'SLACK_API_TOKEN', None) is not None:
-        release_url = getattr(config, 'RELEASE_URL', None)
-        if release_url:
-            send_slack_message(f'This release can be found at: {release_url}')
-        send_slack_file(total_string)
+        send_slack_file(total_string, diff_file)
+    return diff
+
+
+def process_extra_node(extra_node, master_node: Node, loader: ConfigLoader, vault: 'Vaulter',
+                       whitelist_filename, verify_variables_from_files, push=True):
+    """
+    I generate, verify and, if push, push the config for one extra node. I return the config generated for the
+    master node, so extra nodes can run concurrently without changing the master node.
+    """
+    is_proxy = False
+    if 'PROXY_NODE' in config.EXTRA_NODES[extra_node]:
+        if type(config.EXTRA_NODES[extra_node]['PROXY_NODE']) != bool:
+            is_proxy = config.EXTRA_NODES[extra_node]['PROXY_NODE'].lower() == 'true'
+        else:
+            is_proxy = config.EXTRA_NODES[extra_node]['PROXY_NODE']
+    if is_proxy:
+        LOGGER.debug(f'Extra node {extra_node} is a proxy node!')
+    else:
+        LOGGER.debug(f'Extra node {extra_node} is NOT a proxy node!')
+
+    with METRICS.span('generate', node=extra_node):
+        current_xtra_node = Node(path=path, name=extra_node,
+                                 whitelist_path=whitelist_filename,
+                                 verify_vars=verify_variables, verify_secrets=verify_secrets,
+                                 upload_vars_from_file=None,
+                                 verify_vars_from_files=verify_variables_from_files,
+                                 proxy_node=is_proxy)
+        current_xtra_node.get_node_info(loader)
+
+        master_conf = generate_config(master_node, current_xtra_node,
+                                      f'{path}/{config.EXTRA_NODES[extra_node]["EXTRA_NODE_TEMPLATE_PATH"]}',
+                                      master_conf=[])
+        get_vars_from_master(master_node, current_xtra_node)
+        if report_requested():
+            METRICS.gauge('node_config_bytes', loader.own_size(current_xtra_node.conf), node=extra_node)
+    with METRICS.span('verify', node=extra_node):
+        current_xtra_node.verify_node_info(vault,
+                                           search_conf=False,
+                                           verify_vars=config.VERIFY_VARIABLES,
+                                           verify_secrets=config.VERIFY_SECRETS)
+    if not push:
+        return master_conf
+    pushed = fingerprint([current_xtra_node.conf, current_xtra_node.upload_vars])
+    if PUSHED_EXTRA_NODES.get(extra_node) == pushed:
+        LOGGER.info(f'Config of extra node {extra_node} is unchanged since it was last pushed. Skipping git.')
+        return master_conf
+    from gitter import Gitter
+    with METRICS.span('git_clone', node=extra_node):
+        git_repo = Gitter(config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_URL'],
+                          config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_USERNAME'],
+                          config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_TOKEN'],
+                          folder=GIT_REPO_BASE_FOLDERS + '/' + extra_node + '/',
+                          branch=config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_BRANCH'],
+                          mirror_folder=getattr(config, 'GIT_MIRROR_FOLDER', None),
+                          worktree=not getattr(config, 'GIT_WORKTREELESS', False))
+    with METRICS.span('git_push', node=extra_node):
+        git_repo.create_node_file_structure(current_xtra_node, env)
+        git_repo.push_if_diff(dry_run)
+    if not dry_run:
+        PUSHED_EXTRA_NODES[extra_node] = pushed
+    return master_conf
+
+
+def process_extra_nodes(master_node: Node, loader: ConfigLoader, vault: 'Vaulter',
+                        whitelist_filename, verify_variables_from_files, push=True):
+    """
+    I process the extra nodes one by one, or concurrently if EXTRA_NODE_WORKERS is above 1.
+    The master config generated for each extra node is merged in EXTRA_NODES order afterwards either way.
+    """
+    extra_nodes = list(config.EXTRA_NODES)
+    workers = getattr(config, 'EXTRA_NODE_WORKERS', 1)
+    args = (master_node, loader, vault, whitelist_filename, verify_variables_from_files, push)
+    if workers <= 1:
+        contributions = [process_extra_node(extra_node, *args) for extra_node in extra_nodes]
+    else:
+        LOGGER.info(f'Processing {len(extra_nodes)} extra nodes with {workers} workers.')
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(process_extra_node, extra_node, *args) for extra_node in extra_nodes]
+        try:
+            contributions = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)  # Don't start more extra nodes if one failed
+    merge_master_conf(master_node, list(zip(extra_nodes, contributions)))
+
+
+def deploy_to_target(target: dict, master_node: Node, deploy_config=True, diff_file=None):
+    """
+    I diff and, if deploy_config, deploy the master node config to one target. I return 0 or a negative exit code.
+    The diff posted to slack is written to diff_file, see send_slack_file.
+    """
+    config_group = target.get('CONFIG_GROUP', None)
+    diff = None
+    if env != 'ci' or not deploy_config:
+        with METRICS.span('diff', target=target_name(target)):
+            diff = do_diff(target['URL'], target['JWT'], master_node, config_group=config_group, diff_file=diff_file)
+    if dry_run or not deploy_config:
+        return 0
+    with METRICS.span('deploy', target=target_name(target)):
+        return deploy(target['URL'],
+                      target['JWT'],
+                      target['UPLOAD_VARIABLES'],
+                      target['UPLOAD_SECRETS'],
+                      node=master_node,
+                      config_group=config_group,
+                      diff=diff)
+
+
+def target_name(target: dict):
+    if target.get('CONFIG_GROUP') is None:
+        return target['URL']
+    return f'{target["URL"]}/{target["CONFIG_GROUP"]}'
+
+
+def diff_file_path(name: str):
+    """
+    I return the file the diff of target name is written to when there are several targets, so targets diffed
+    concurrently do not overwrite each other's file. A single target keeps ./<env>-diff.txt.
+    """
+    return f'./{env}-{regex_sub(r"[^A-Za-z0-9.]+", "-", name).strip("-")}-diff.txt'
+
+
+def target_result(name: str, result):
+    """
+    I return the exit code from calling result, or -7 if it raised, so every target gets a result.
+    """
+    try:
+        return result()
+    except Exception as e:
+        LOGGER.critical(f'Got exception "{e}" while deploying to target "{name}"')
+        return -7
+
+
+def deploy_to_targets(targets: list, master_node: Node, deploy_config=True):
+    """
+    I diff and deploy the master node config, which is prepared and verified once, to every target concurrently.
+    I return {<target name>: <0 or negative exit code>} in target order. A failing target does not stop the others.
+    """
+    names = [target_name(target) for target in targets]
+    diff_files = [diff_file_path(name) if len(targets) > 1 else None for name in names]
+    release_url = getattr(config, 'RELEASE_URL', None)
+    if (env != 'ci' or not deploy_config) and release_url and getattr(config, 'SLACK_API_TOKEN', None) is not None:
+        send_slack_message(f'This release can be found at: {release_url}')  # Once, before the diff of each target
+    results = {}
+    if len(targets) <= 1:  # No thread pool needed
+        for name, target, diff_file in zip(names, targets, diff_files):
+            results[name] = target_result(name, lambda: deploy_to_target(target, master_node, deploy_config,
+                                                                         diff_file))
+    else:
+        with ThreadPoolExecutor(max_workers=getattr(config, 'TARGET_WORKERS', len(targets))) as executor:
+            futures = [executor.submit(deploy_to_target, target, master_node, deploy_config, diff_file)
+                       for target, diff_file in zip(targets, diff_files)]
+            for name, future in zip(names, futures):
+                results[name] = target_result(name, future.result)
+    for name, code in results.items():
+        if code == 0:
+            LOGGER.info(f'Target "{name}": OK')
+        else:
+            LOGGER.critical(f'Target "{name}": failed with exit code {code}')
+    LOGGER.info(f'{len([c for c in results.values() if c == 0])} of {len(results)} targets succeeded.')
+    return results
 
 
-def main():
-    variables_filename = None
-    verify_variables_from_files = None
-    whitelist_filename = None
-    name = None
+def node_files():
+    """
+    I return the name, variables file, variables files to verify against and whitelist file of the master node.
+    """
     if env == 'prod' or env == 'test':
         variables_filename = getattr(config, 'UPLOAD_VARIABLES_FROM_FILE', f'variables/variables-{env}.json')
         verify_variables_from_files = getattr(config, 'VERIFY_VARIABLES_FROM_FILES', [variables_filename])
         whitelist_filename = getattr(config, 'WHITELIST_FILE_PATH', f'deployment/whitelist-{env}.txt')
-        name = 'master'
-    elif env == 'ci':
+        return 'master', variables_filename, verify_variables_from_files, whitelist_filename
+    if env == 'ci':
         variables_filename = getattr(config, 'UPLOAD_VARIABLES_FROM_FILE', f'test-env.json')
         whitelist_filename = getattr(config, 'WHITELIST_FILE_PATH', f'deployment/whitelist-master.txt')
         verify_variables_from_files = getattr(config, 'VERIFY_VARIABLES_FROM_FILES',
                                               ['variables/variables-test.json', 'variables/variables-prod.json'])
-        name = None
-    else:
-        LOGGER.critical(f'Environment "{env}" is not test, prod or test')
-    LOGGER.info(
-        f'Running with options: env: "{env}" | Verify Variables: "{config.VERIFY_VARIABLES}" | Verify Secrets: "{config.VERIFY_SECRETS}" | Dry Run: "{dry_run}"')
+        return None, variables_filename, verify_variables_from_files, whitelist_filename
+    LOGGER.critical(f'Environment "{env}" is not test, prod or test')
+    return None, None, None, None
+
+
+def get_loader():
+    parse_cache = None
+    if getattr(config, 'PARSE_CACHE_FILE', None):
+        parse_cache = ParseCache(config.PARSE_CACHE_FILE)
+    return ConfigLoader(cache=parse_cache)  # Parses each whitelisted file once for master and all extra nodes
+
+
+def load_master_node(loader: ConfigLoader, name, variables_filename, verify_variables_from_files,
+                     whitelist_filename):
+    """
+    I return the master node with its config read from NODE_FOLDER through loader.
+    """
     master_node = Node(path=path, name=name, whitelist_path=whitelist_filename,
                        verify_vars=verify_variables, verify_secrets=verify_secrets,
                        upload_vars_from_file=variables_filename,
                        verify_vars_from_files=verify_variables_from_files)
-    master_node.get_node_info()
-    vault = None
-    if config.VERIFY_SECRETS is True and config.VAULT_AUTH=="git-token":
-        if getattr(config, "VAULT_PATH_PREFIX", None):
-            vault = Vaulter(url=config.VAULT_URL,
-                            token=config.VAULT_GIT_TOKEN,
-                            mount_point=config.VAULT_MOUNTING_POINT,
-                            vault_path_prefix=config.VAULT_PATH_PREFIX,auth_type="git-token")
-        else:
-            vault = Vaulter(url=config.VAULT_URL,
-                            token=config.VAULT_GIT_TOKEN,
-                            mount_point=config.VAULT_MOUNTING_POINT,auth_type="git-token")
-    
-    if config.VERIFY_SECRETS is True and config.VAULT_AUTH=="approle":
-        if getattr(config, "VAULT_PATH_PREFIX", None):
-            vault = Vaulter(url=config.VAULT_URL,
-                            token=config.VAULT_APPROLE_ID,
-                            mount_point=config.VAULT_MOUNTING_POINT,
-                            vault_path_prefix=config.VAULT_PATH_PREFIX,auth_type="approle")
-        else:
-            vault = Vaulter(url=config.VAULT_URL,
-                            token=config.VAULT_APPROLE_ID,
-                            mount_point=config.VAULT_MOUNTING_POINT,auth_type="approle")
-
+    master_node.get_node_info(loader)
+    if loader.cache is not None:
+        loader.cache.write()
+    return master_node
+
+
+def get_vault():
+    """
+    I return the vault to verify secrets in, or None if VERIFY_SECRETS is not set. The vault is made once.
+    """
+    if 'vault' in VAULT:
+        return VAULT['vault']
+    vault_auth = getattr(config, 'VAULT_AUTH', None)
+    if config.VERIFY_SECRETS is not True or vault_auth not in ['git-token', 'approle']:
+        VAULT['vault'] = None
+        return None
+    from Vaulter import Vaulter
+    optional = {}
+    if getattr(config, "VAULT_PATH_PREFIX", None):
+        optional['vault_path_prefix'] = config.VAULT_PATH_PREFIX
+    VAULT['vault'] = Vaulter(url=config.VAULT_URL,
+                             token=config.VAULT_GIT_TOKEN if vault_auth == 'git-token' else config.VAULT_APPROLE_ID,
+                             mount_point=config.VAULT_MOUNTING_POINT, auth_type=vault_auth,
+                             max_workers=getattr(config, "VAULT_WORKERS", 8),
+                             cache_ttl=getattr(config, "VAULT_CACHE_TTL", 300),
+                             cache_size=getattr(config, "VAULT_CACHE_SIZE", 10000),
+                             **optional)
+    return VAULT['vault']
+
+
+COMMANDS = ['verify', 'generate-extra', 'diff', 'deploy']
+
+
+def main(command='deploy', loader: ConfigLoader = None):
+    """
+    I run command, one of COMMANDS. Each does the steps of the one before it, leaving out what it does not need:
+    verify reads and verifies the config, generate-extra generates, verifies and pushes the extra nodes, diff diffs
+    the config against every MASTER_NODE target, and deploy does all of it and deploys. Call load_config first.
+    Files already parsed by loader are not read again.
+    """
+    name, variables_filename, verify_variables_from_files, whitelist_filename = node_files()
+    LOGGER.info(
+        f'Running {command} with options: env: "{env}" | Verify Variables: "{config.VERIFY_VARIABLES}" | Verify Secrets: "{config.VERIFY_SECRETS}" | Dry Run: "{dry_run}"')
+    with METRICS.span('config_load'):
+        if loader is None:
+            loader = get_loader()
+        master_node = load_master_node(loader, name, variables_filename, verify_variables_from_files,
+                                       whitelist_filename)
+    vault = get_vault()
 
     if getenv("EXTRA_NODES", None) is not None and env != 'ci':
-        for extra_node in config.EXTRA_NODES:
-            is_proxy = False
-            if 'PROXY_NODE' in config.EXTRA_NODES[extra_node]:
-                if type(config.EXTRA_NODES[extra_node]['PROXY_NODE']) != bool:
-                    is_proxy = config.EXTRA_NODES[extra_node]['PROXY_NODE'].lower() == 'true'
-                else:
-                    is_proxy = config.EXTRA_NODES[extra_node]['PROXY_NODE']
-            if is_proxy:
-                LOGGER.debug(f'Extra node {extra_node} is a proxy node!')
-            else:
-                LOGGER.debug(f'Extra node {extra_node} is NOT a proxy node!')
-
-
-
-            current_xtra_node = Node(path=path, name=extra_node,
-                                     whitelist_path=whitelist_filename,
-                                     verify_vars=verify_variables, verify_secrets=verify_secrets,
-                                     upload_vars_from_file=None,
-                                     verify_vars_from_files=verify_variables_from_files,
-                                     proxy_node=is_proxy)
-            current_xtra_node.get_node_info()
-
-            generate_config(master_node, current_xtra_node,
-                            f'{path}/{config.EXTRA_NODES[extra_node]["EXTRA_NODE_TEMPLATE_PATH"]}')
-            get_vars_from_master(master_node, current_xtra_node)
-            current_xtra_node.verify_node_info(vault,
-                                               search_conf=False,
-                                               verify_vars=config.VERIFY_VARIABLES,
-                                               verify_secrets=config.VERIFY_SECRETS)
-            git_repo = Gitter(config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_URL'],
-                              config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_USERNAME'],
-                              config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_TOKEN'],
-                              folder=GIT_REPO_BASE_FOLDERS + '/' + extra_node + '/',
-                              branch=config.EXTRA_NODES[extra_node]['EXTRA_NODE_GIT_BRANCH'])
-            git_repo.create_node_file_structure(current_xtra_node, env)
-            git_repo.push_if_diff(dry_run)
-    master_node.verify_node_info(vault,
-                                 search_conf=True,
-                                 verify_vars=config.VERIFY_VARIABLES,
-                                 verify_secrets=config.VERIFY_SECRETS)
-    if env != 'ci':
-        do_diff(config.MASTER_NODE['URL'],
-                config.MASTER_NODE['JWT'],
-                master_node,
-                config_group=config.MASTER_NODE.get('CONFIG_GROUP', None))
-    if dry_run:
+        with METRICS.span('extra_nodes'):
+            # Extra node config is always generated, as it adds to the master node config
+            process_extra_nodes(master_node, loader, vault, whitelist_filename, verify_variables_from_files,
+                                push=command in ['generate-extra', 'deploy'])
+    elif command == 'generate-extra':
+        LOGGER.warning('EXTRA_NODES is not set or ENVIRONMENT is ci, no extra nodes to generate.')
+    if command == 'generate-extra':
+        LOGGER.info('Successfully generated extra nodes!')
+        return
+    with METRICS.span('verify'):
+        master_node.verify_node_info(vault,
+                                     search_conf=True,
+                                     verify_vars=config.VERIFY_VARIABLES,
+                                     verify_secrets=config.VERIFY_SECRETS)
+    if report_requested():
+        METRICS.gauge('document_store_bytes', loader.shared_size())
+        METRICS.gauge('document_store_strings', len(loader.store.strings))
+        METRICS.gauge('node_config_bytes', loader.own_size(master_node.conf), node='master')
+    if command == 'verify':
+        LOGGER.info('Successfully verified config!')
+        return
+    targets = getattr(config, 'MASTER_NODE', [])  # Not set when only verifying config in ci
+    results = deploy_to_targets(targets if type(targets) is list else [targets], master_node,
+                                deploy_config=command == 'deploy')
+    for client in NODE_CLIENTS.values():
+        LOGGER.info(client.get_latency_summary())
+    failed = [code for code in results.values() if code != 0]
+    if len(failed) != 0:
+        exit(failed[0])
+    if command == 'diff':
+        LOGGER.info('Successfully diffed config!')
+    elif dry_run:
         LOGGER.info('Succesfully completed dry run!')
     else:
-        deploy(config.MASTER_NODE['URL'],
-               config.MASTER_NODE['JWT'],
-               config.MASTER_NODE['UPLOAD_VARIABLES'],
-               config.MASTER_NODE['UPLOAD_SECRETS'],
-               node=master_node,
-               config_group=config.MASTER_NODE.get('CONFIG_GROUP', None))
         LOGGER.info('Successfully deployed!')
 
 
+def watch(command='deploy'):
+    """
+    I run command, then poll NODE_FOLDER every WATCH_INTERVAL seconds and run it again when files change, until
+    stopped. Between runs I keep the parsed files (only changed files are parsed again), the Vault login and secret
+    cache, the HTTP connection pools and the git mirrors. Unless set, DEPLOY_MODE is incremental, so only the changed
+    pipes and systems are sent to the node, and GIT_MIRROR_FOLDER is GIT_MIRRORS. With WATCH_GIT_PULL=true,
+    NODE_FOLDER is a git checkout which is pulled before every poll. A failed run is logged and does not stop me.
+    """
+    interval = getattr(config, 'WATCH_INTERVAL', 5)
+    if getattr(config, 'DEPLOY_MODE', None) is None:
+        config.DEPLOY_MODE = 'incremental'
+    if getattr(config, 'GIT_MIRROR_FOLDER', None) is None:
+        config.GIT_MIRROR_FOLDER = 'GIT_MIRRORS'
+    loader = get_loader()
+    watcher = FolderWatcher(path)
+    changes = None  # The first run reads every file
+    while True:
+        if changes is None or len(changes) != 0:
+            if changes is not None:
+                LOGGER.info(f'Running {command} for {len(changes)} changed files: {changes[:10]}')
+                loader.forget(changes)
+            start = perf_counter()
+            try:
+                start_watch_run()
+                main(command, loader)
+                LOGGER.info(f'Finished {command} in {perf_counter() - start:.1f} seconds. Watching "{path}".')
+            except SystemExit as e:  # The deployer exits on failed verification and failed requests
+                LOGGER.error(f'{command} failed with exit code {e.code}. Waiting for the next change.')
+            except Exception as e:
+                LOGGER.exception(f'{command} failed with exception "{e}". Waiting for the next change.')
+            write_run_report()
+        sleep(interval)
+        if getattr(config, 'WATCH_GIT_PULL', False):
+            pull_node_folder()
+        changes = watcher.changes()
+        while len(changes) != 0:  # Wait until files stop changing, e.g. during a checkout
+            sleep(min(interval, 1))
+            more_changes = watcher.changes()
+            if len(more_changes) == 0:
+                break
+            changes = sorted(set(changes) | set(more_changes))
+
+
+def start_watch_run():
+    """
+    I reset what is collected per run, so every run in watch mode reports only itself, and log in to Vault again if
+    the token of the warm vault client has expired.
+    """
+    METRICS.reset()
+    with NODE_CLIENTS_LOCK:
+        clients = list(NODE_CLIENTS.values())
+    for client in clients:
+        client.reset_latencies()
+    vault = VAULT.get('vault')
+    if vault is not None:
+        vault.reset_latencies()
+        vault.ensure_authenticated()
+
+
+def pull_node_folder():
+    from git import Repo
+    from git.exc import GitCommandError
+    try:
+        with METRICS.timed('git_operation', operation='pull'):
+            Repo(path, search_parent_directories=True).remote('origin').pull(ff_only=True)
+    except GitCommandError as e:
+        LOGGER.warning(f'Could not pull "{path}". Error: {e}')
+
+
+def report_requested():
+    return bool(getattr(config, 'RUN_REPORT_FILE', None) or getattr(config, 'PROMETHEUS_TEXTFILE', None))
+
+
+def write_run_report():
+    """
+    I write the timings and counters of the run to RUN_REPORT_FILE and PROMETHEUS_TEXTFILE if they are set.
+    """
+    try:
+        if getattr(config, 'RUN_REPORT_FILE', None):
+            METRICS.write_report(config.RUN_REPORT_FILE)
+            LOGGER.info(f'Wrote run report to "{config.RUN_REPORT_FILE}"')
+        if getattr(config, 'PROMETHEUS_TEXTFILE', None):
+            METRICS.write_prometheus(config.PROMETHEUS_TEXTFILE)
+            LOGGER.info(f'Wrote Prometheus metrics to "{config.PROMETHEUS_TEXTFILE}"')
+    except OSError as e:
+        LOGGER.warning(f'Could not write run report. Error: {e}')
+
+
 if __name__ == '__main__':
-    main()
+    load_config()
+    try:
+        main()
+    finally:
+        write_run_report()  # Also for failed runs, which exit from deep inside main
     exit(0)
@@ -0,0 +1,100 @@
+from sys import getsizeof
+from threading import Lock
+
+
+class DocumentStore:
+    """
+    I keep one copy of every key and string in the config documents of a run. A key like "_id" or a value like
+    "dataset" is stored once, however many documents and nodes use it.
+
+    Documents are never changed after they are added. Nodes hold references to them instead of copies, and config
+    rendered from templates shares the constant parts of the template, so only what differs per node is new memory.
+    Adding is safe from several threads: dict.setdefault is atomic for str keys.
+    """
+
+    def __init__(self):
+        self.strings = {}  # {<str>: <the same str>}
+        self.documents = 0
+        self.shared_ids = None  # ids of the objects in shared documents, see own_size
+        self.lock = Lock()
+
+    def add(self, document, dollar_strings: list = None):
+        """
+        I return a copy of document with interned keys and strings. Keys and strings containing a $ are appended to
+        dollar_strings in document order, so $ENV and $SECRET references are found in the same pass.
+        """
+        intern = self.strings.setdefault
+        found = dollar_strings if dollar_strings is not None else []
+
+        def walk(value):
+            if type(value) is dict:
+                compact = {}
+                for k, v in value.items():
+                    if '$' in k:
+                        found.append(k)
+                    t = type(v)
+                    if t is str:
+                        if '$' in v:
+                            found.append(v)
+                        v = intern(v, v)
+                    elif t is dict or t is list:
+                        v = walk(v)
+                    compact[intern(k, k)] = v
+                return compact
+            compact = []
+            for v in value:
+                t = type(v)
+                if t is str:
+                    if '$' in v:
+                        found.append(v)
+                    v = intern(v, v)
+                elif t is dict or t is list:
+                    v = walk(v)
+                compact.append(v)
+            return compact
+
+        with self.lock:
+            self.documents += 1
+            self.shared_ids = None
+        if type(document) is str:
+            if '$' in document:
+                found.append(document)
+            return intern(document, document)
+        if type(document) not in [dict, list]:
+            return document
+        return walk(document)
+
+    def own_size(self, documents, shared_documents):
+        """
+        I return the bytes of the objects in documents which are not in shared_documents, e.g. the config list of a
+        node and the config rendered for it. The shared objects are found once and remembered until the next add.
+        """
+        with self.lock:
+            if self.shared_ids is None:
+                self.shared_ids = set()
+                deep_size(shared_documents, seen=self.shared_ids)
+            shared_ids = self.shared_ids
+        return deep_size(documents, exclude=shared_ids)
+
+
+def deep_size(value, seen: set = None, exclude=frozenset()):
+    """
+    I return the bytes of value and every dict, list and str in it, counting each object once.
+    The ids of the objects counted are added to seen, objects with an id in exclude are not counted.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [value]
+    while len(stack) != 0:
+        cur = stack.pop()
+        if id(cur) in seen or id(cur) in exclude:
+            continue
+        seen.add(id(cur))
+        size += getsizeof(cur)
+        if type(cur) is dict:
+            stack.extend(cur.keys())
+            stack.extend(cur.values())
+        elif type(cur) in [list, tuple]:
+            stack.extend(cur)
+    return size
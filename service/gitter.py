@@ -1,29 +1,97 @@
 from Node import Node
+from json_backend import dump_json_bytes
+from metrics import METRICS
 from shutil import rmtree
 # from config_creator import create_file_structure
-from sesamutils import sesam_logger
-from os import mkdir
+from logger import get_logger
+from os import mkdir, makedirs, path as os_path, remove, walk
 from git import Repo
-import subprocess
-from json import dumps as dump_json
+from git.objects import Commit, Tree
+from git.objects.fun import tree_to_stream
+from gitdb import IStream
+from hashlib import sha1, sha256
+from io import BytesIO
+from threading import Lock
+
+MIRROR_LOCKS = {}  # {<bare repo path>: Lock}, so extra nodes sharing a mirror don't fetch or push at the same time
+MIRROR_LOCKS_LOCK = Lock()
+FILE_MODE = 0o100644
+TREE_MODE = 0o040000
 
 
 class Gitter:
-    def __init__(self, url, username, password_or_token, folder, branch):
+    def __init__(self, url, username, password_or_token, folder, branch, mirror_folder=None, worktree=True):
         self.url = url
         self.username = username
         self.password_or_token = password_or_token
         self.folder = folder
         self.branch = branch
+        self.mirror_folder = mirror_folder
+        self.worktree = worktree  # If False, node files are written straight into the object database of a bare repo
+        self.tree = None  # Root tree of the new commit, if there is no worktree
+        self.changes = None  # {added: [<file>], changed: [<file>], removed: [<file>]} after writing node files
+
+        self.LOGGER = get_logger('Git')
 
-        self.LOGGER = sesam_logger('Git')
+        if self.worktree:
+            self.repo = self.clone_repo()
+        else:
+            self.repo = self.fetch_bare_repo()
 
-        self.repo = self.clone_repo()
+    def remote_url(self):
+        if self.url.startswith('file://'):  # Local repositories need no credentials
+            return self.url
+        return f'https://{self.username}:{self.password_or_token}@{self.url}'
 
     def clone_repo(self):
+        """
+        I make a shallow clone of the branch with only node/ checked out, so clone time does not grow with history.
+        If a mirror folder is set, I clone from a local mirror of the repo which is updated with a fetch.
+        """
         self.try_to_delete_dir(self.folder)
-        url = f'https://{self.username}:{self.password_or_token}@{self.url}'
-        repo = Repo.clone_from(url, self.folder, branch=self.branch)
+        url = self.remote_url()
+        source = url
+        if self.mirror_folder is not None:
+            source = f'file://{os_path.abspath(self.update_bare_repo(self.get_mirror_path()).git_dir)}'
+        with METRICS.timed('git_operation', operation='clone'):
+            repo = Repo.clone_from(source, self.folder, branch=self.branch, depth=1, no_checkout=True)
+            repo.git.sparse_checkout('set', 'node')
+            repo.git.checkout(self.branch)
+        if source != url:
+            repo.remote('origin').set_url(url)  # Push to the real repo, not the mirror
+        return repo
+
+    def fetch_bare_repo(self):
+        """
+        I return a bare repo with the branch fetched, without checking anything out.
+        This is the mirror if a mirror folder is set, otherwise a new bare repo in the folder.
+        """
+        if self.mirror_folder is not None:
+            return self.update_bare_repo(self.get_mirror_path())
+        self.try_to_delete_dir(self.folder)
+        return self.update_bare_repo(self.folder)
+
+    def get_mirror_path(self):
+        return f'{self.mirror_folder}/{sha256(self.url.encode("UTF-8")).hexdigest()[:16]}.git'
+
+    def get_lock(self):
+        repo_path = self.get_mirror_path() if self.mirror_folder is not None else self.folder
+        with MIRROR_LOCKS_LOCK:
+            return MIRROR_LOCKS.setdefault(os_path.abspath(repo_path), Lock())
+
+    def update_bare_repo(self, repo_path):
+        with self.get_lock():
+            if os_path.isdir(repo_path):
+                repo = Repo(repo_path)
+                repo.remote('origin').set_url(self.remote_url())  # The token might have changed
+            else:
+                self.LOGGER.info(f'Creating bare repo of "{self.url}" in "{repo_path}"')
+                makedirs(repo_path)
+                repo = Repo.init(repo_path, bare=True)
+                repo.create_remote('origin', self.remote_url())
+            self.LOGGER.debug(f'Fetching branch "{self.branch}" into "{repo_path}"')
+            with METRICS.timed('git_operation', operation='fetch'):
+                repo.git.fetch('origin', f'+refs/heads/{self.branch}:refs/heads/{self.branch}', depth=1)
         return repo
 
     def push_if_diff(self, dry_run=False):
@@ -37,22 +105,28 @@ class Gitter:
             self.LOGGER.info('No current diff! Skipping push to repo.')
 
     def is_there_a_diff(self):
-        import subprocess
-        bashCommand = 'git status'
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE, cwd=self.repo.working_dir + '/node/')
-        output, error = process.communicate()
-        if output.endswith(b"working tree clean\n"):
+        """
+        I use the changes found while writing the node files instead of asking git.
+        """
+        if self.changes is None:
             return False
-        else:
-            self.LOGGER.info(f'Git status result : "{output}"')
-            return True
+        changed_files = sum(len(files) for files in self.changes.values())
+        if changed_files == 0:
+            return False
+        self.LOGGER.info(f'Changed files: {self.changes}')
+        return True
 
     def push(self):
         self.LOGGER.debug(f"Pushing to git repo {self.repo.remote}")
-        self.repo.git.add([self.repo.working_dir])
-        self.repo.index.commit(message='Update based on master node config')
+        if not self.worktree:
+            self.commit_tree_and_push()
+            return
+        with METRICS.timed('git_operation', operation='commit'):
+            self.repo.git.add([self.repo.working_dir])
+            self.repo.index.commit(message='Update based on master node config')
         origin = self.repo.remote('origin')
-        origin.push()
+        with METRICS.timed('git_operation', operation='push'):
+            origin.push()
 
     def try_to_delete_dir(self, directory):
         try:
@@ -69,23 +143,136 @@ class Gitter:
             self.LOGGER.info(f'Did not create "{directory}" because it already exists!')
 
     def create_node_file_structure(self, node: Node, env):
-        self.try_to_delete_dir(f'{self.repo.working_dir}/node')
-        for p in [
-            f'{self.repo.working_dir}/node/',
-            f'{self.repo.working_dir}/node/pipes/',
-            f'{self.repo.working_dir}/node/systems/',
-            f'{self.repo.working_dir}/node/variables/'
-        ]:
-            self.try_to_make_dir(p)
-        tmp_file = None
-        for conf in node.conf:
-            if conf['type'] == 'pipe':
-                tmp_file = open(f'{self.repo.working_dir}/node/pipes/{conf["_id"]}.conf.json', 'w+')
-            if 'system' in conf['type']:
-                tmp_file = open(f'{self.repo.working_dir}/node/systems/{conf["_id"]}.conf.json', 'w+')
-            if conf['type'] == 'metadata':
-                tmp_file = open(f'{self.repo.working_dir}/node/node-metadata.conf.json', 'w+')
-            tmp_file.write(dump_json(conf, indent=2))
-        if len([key for key in node.upload_vars]) != 0:
-            tmp_file = open(f'{self.repo.working_dir}/node/variables/variables-{env}.json', 'w+')
-            tmp_file.write(dump_json(node.upload_vars, indent=2))
+        """
+        I only write node files which are new or changed, and only delete files which are no longer in the config.
+        """
+        if not self.worktree:
+            self.write_node_tree(node, env)
+            return
+        node_folder = f'{self.repo.working_dir}/node'
+        new_files = node_files(node, env)
+        existing_files = set()
+        for directory, _, filenames in walk(node_folder):
+            for filename in filenames:
+                existing_files.add(os_path.relpath(f'{directory}/{filename}', node_folder).replace(os_path.sep, '/'))
+
+        self.changes = {'added': [], 'changed': [], 'removed': []}
+        for filename, content in new_files.items():
+            file_path = f'{node_folder}/{filename}'
+            if filename in existing_files:
+                if content_hash(open(file_path, 'rb').read()) == content_hash(content):
+                    continue
+                self.changes['changed'].append(filename)
+            else:
+                makedirs(os_path.dirname(file_path), exist_ok=True)
+                self.changes['added'].append(filename)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+        for filename in sorted(existing_files - set(new_files)):
+            remove(f'{node_folder}/{filename}')
+            self.changes['removed'].append(filename)
+        self.LOGGER.debug(f'Added {len(self.changes["added"])}, changed {len(self.changes["changed"])} and removed '
+                          f'{len(self.changes["removed"])} files in "{node_folder}"')
+
+    def write_node_tree(self, node: Node, env):
+        """
+        I write the node files as blobs and trees straight into the object database, replacing node/ in the tree of
+        the branch. Objects which already exist, like unchanged files and folders, are not written again.
+        """
+        parent = self.repo.commit(f'refs/heads/{self.branch}')
+        new_files = node_files(node, env)
+        old_files = {}
+        root_entries = []
+        for item in parent.tree:
+            if item.name != 'node':
+                root_entries.append((item.binsha, item.mode, item.name))
+            elif item.type == 'tree':
+                for blob in item.traverse():
+                    if blob.type == 'blob':
+                        old_files[blob.path[len('node/'):]] = blob.binsha
+
+        node_tree = {}
+        self.changes = {'added': [], 'changed': [], 'removed': []}
+        for filename, content in new_files.items():
+            binsha = write_object(self.repo, b'blob', content)
+            if filename not in old_files:
+                self.changes['added'].append(filename)
+            elif old_files[filename] != binsha:
+                self.changes['changed'].append(filename)
+            folder = node_tree
+            *folders, name = filename.split('/')
+            for f in folders:
+                folder = folder.setdefault(f, {})
+            folder[name] = binsha
+        self.changes['removed'] = sorted(set(old_files) - set(new_files))
+
+        if len(node_tree) != 0:
+            root_entries.append((write_tree(self.repo, node_tree), TREE_MODE, 'node'))
+        self.tree = write_tree(self.repo, {}, root_entries)
+        if self.tree == parent.tree.binsha:
+            self.changes = {'added': [], 'changed': [], 'removed': []}
+
+    def commit_tree_and_push(self):
+        """
+        I commit the tree from write_node_tree on top of the branch and push it, without any worktree.
+        """
+        with self.get_lock():
+            with METRICS.timed('git_operation', operation='commit'):
+                parent = self.repo.commit(f'refs/heads/{self.branch}')
+                commit = Commit.create_from_tree(self.repo, Tree(self.repo, self.tree),
+                                                 message='Update based on master node config',
+                                                 parent_commits=[parent], head=False)
+                self.repo.git.update_ref(f'refs/heads/{self.branch}', commit.hexsha, parent.hexsha)
+            with METRICS.timed('git_operation', operation='push'):
+                self.repo.remote('origin').push(f'refs/heads/{self.branch}:refs/heads/{self.branch}')
+
+
+def write_object(repo: Repo, kind: bytes, data: bytes):
+    """
+    I return the binsha of a git object, and only write it to the object database if it is not there already.
+    """
+    binsha = sha1(kind + b' ' + str(len(data)).encode('UTF-8') + b'\0' + data).digest()
+    if not repo.odb.has_object(binsha):
+        repo.odb.store(IStream(kind, len(data), BytesIO(data)))
+    return binsha
+
+
+def write_tree(repo: Repo, tree: dict, entries: list = None):
+    """
+    I write a tree of {<name>: <blob binsha> or <subtree dict>}, plus already written (binsha, mode, name) entries.
+    """
+    entries = list(entries or [])
+    for name, value in tree.items():
+        if type(value) is dict:
+            entries.append((write_tree(repo, value), TREE_MODE, name))
+        else:
+            entries.append((value, FILE_MODE, name))
+    # Git sorts folders as if their name ended with a slash
+    entries.sort(key=lambda e: e[2].encode('UTF-8') + (b'/' if e[1] == TREE_MODE else b''))
+    stream = BytesIO()
+    tree_to_stream(entries, stream.write)
+    return write_object(repo, b'tree', stream.getvalue())
+
+
+def node_files(node: Node, env):
+    """
+    I return {<path relative to node/>: <content>} for every file the node config is written to.
+    """
+    files = {}
+    for conf in node.conf:
+        if conf['type'] == 'pipe':
+            filename = f'pipes/{conf["_id"]}.conf.json'
+        elif 'system' in conf['type']:
+            filename = f'systems/{conf["_id"]}.conf.json'
+        elif conf['type'] == 'metadata':
+            filename = 'node-metadata.conf.json'
+        else:
+            continue
+        files[filename] = dump_json_bytes(conf, indent=2)
+    if len([key for key in node.upload_vars]) != 0:
+        files[f'variables/variables-{env}.json'] = dump_json_bytes(node.upload_vars, indent=2)
+    return files
+
+
+def content_hash(content: bytes):
+    return sha256(content).hexdigest()
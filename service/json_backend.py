@@ -0,0 +1,159 @@
+from json import loads as stdlib_loads, dumps as stdlib_dumps
+from re import compile as regex_compile
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, everything works with the stdlib json module
+    orjson = None
+
+# orjson writes some floats differently from the stdlib (1e16 as 1e16, not 1e+16, and 1e-05 as 0.00001), and NaN as
+# null. Output where this could happen is checked, so committed files are the same whichever backend made them.
+FLOAT_OR_NULL_REGEX = regex_compile(rb'[0-9](?:\.|e)|null')
+NULL_REGEX = regex_compile(rb'null')
+# orjson reads integers above 64 bit as floats. Input with 20 digits in a row is read by the stdlib. Mapping every
+# digit to 0 and searching for twenty 0s is a lot faster than a regex.
+DIGITS_TO_ZERO = str.maketrans('123456789', '000000000')
+DIGITS_TO_ZERO_BYTES = bytes.maketrans(b'123456789', b'000000000')
+NON_ASCII_REGEX = regex_compile(r'[^\x00-\x7e]')
+CHUNK_SIZE = 1 << 16
+
+backend = 'orjson' if orjson is not None else 'stdlib'
+
+
+def use_backend(name: str):
+    """
+    I switch the backend to orjson or stdlib. orjson is only used if it is installed.
+    """
+    global backend
+    if name not in ['orjson', 'stdlib']:
+        raise ValueError(f'Unknown json backend "{name}". Use orjson or stdlib.')
+    backend = name if orjson is not None else 'stdlib'
+    return backend
+
+
+def load_json(data):
+    """
+    I parse json from str or bytes, like json.loads.
+    """
+    if backend == 'orjson':
+        if type(data) is bytes:
+            might_have_big_integer = b'0' * 20 in data.translate(DIGITS_TO_ZERO_BYTES)
+        else:
+            might_have_big_integer = '0' * 20 in data.translate(DIGITS_TO_ZERO)
+        if not might_have_big_integer:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass  # NaN and Infinity are only read by the stdlib. It raises if the json is really invalid
+    return stdlib_loads(data)
+
+
+def dump_json(obj, indent=None, sort_keys=False, ensure_ascii=True):
+    """
+    I return the same str as json.dumps with these arguments, faster with orjson for indent=2.
+    """
+    return dump_json_bytes(obj, indent, sort_keys, ensure_ascii).decode('UTF-8')
+
+
+def dump_json_bytes(obj, indent=None, sort_keys=False, ensure_ascii=True):
+    """
+    I return the same bytes as json.dumps with these arguments encoded as UTF-8. Use me for files which are committed.
+    """
+    if backend == 'orjson' and indent == 2:
+        output = orjson_dumps(obj, orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+        if output is not None:
+            if ensure_ascii and (not output.isascii() or b'\x7f' in output):
+                return NON_ASCII_REGEX.sub(escape_non_ascii, output.decode('UTF-8')).encode('UTF-8')
+            return output
+    return stdlib_dumps(obj, indent=indent, sort_keys=sort_keys, ensure_ascii=ensure_ascii).encode('UTF-8')
+
+
+def dump_json_compact(obj, sort_keys=False):
+    """
+    I return compact json as bytes for request bodies, caches and hashes. The exact bytes depend on the backend,
+    so never commit them or compare them between runs with different backends.
+    """
+    if backend == 'orjson':
+        output = orjson_dumps(obj, orjson.OPT_SORT_KEYS if sort_keys else 0, exact=False)
+        if output is not None:
+            return output
+    return stdlib_dumps(obj, sort_keys=sort_keys, separators=(',', ':')).encode('UTF-8')
+
+
+def write_json(obj, f, sort_keys=False):
+    """
+    I write compact json to a binary file in chunks from iter_json, instead of building it in memory.
+    """
+    for chunk in iter_json(obj, sort_keys):
+        f.write(chunk)
+
+
+def iter_json(obj, sort_keys=False):
+    """
+    I yield compact json as bytes in chunks of about CHUNK_SIZE. A list, or a dict with str keys, like a node config
+    or a cache, is encoded one item at a time with either backend, so only the largest item is ever built in memory.
+    """
+    if type(obj) is list:
+        start, end = b'[', b']'
+        items = ((None, value) for value in obj)
+    elif type(obj) is dict and all(type(key) is str for key in obj):
+        start, end = b'{', b'}'
+        items = ((key, obj[key]) for key in (sorted(obj) if sort_keys else obj))
+    else:
+        yield dump_json_compact(obj, sort_keys)
+        return
+    chunks = [start]
+    size = 0
+    for i, (key, value) in enumerate(items):
+        if i != 0:
+            chunks.append(b',')
+        if key is not None:
+            chunks.append(stdlib_dumps(key).encode('UTF-8') + b':')
+        chunk = dump_json_compact(value, sort_keys)
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunks)
+            chunks = []
+            size = 0
+    chunks.append(end)
+    yield b''.join(chunks)
+
+
+def orjson_dumps(obj, option, exact=True):
+    """
+    I return orjson output, or None if orjson can not write obj (non str keys, integers above 64 bit) or would
+    write NaN or Infinity as null. If exact, also None if orjson writes a float differently from the stdlib.
+    """
+    try:
+        output = orjson.dumps(obj, option=option)
+    except orjson.JSONEncodeError:
+        return None
+    if (FLOAT_OR_NULL_REGEX if exact else NULL_REGEX).search(output) is not None \
+            and has_float_written_differently(obj, exact):
+        return None
+    return output
+
+
+def has_float_written_differently(obj, exact=True):
+    stack = [obj]
+    while len(stack) != 0:
+        cur = stack.pop()
+        if type(cur) is dict:
+            stack.extend(cur.values())
+        elif type(cur) in [list, tuple]:
+            stack.extend(cur)
+        elif type(cur) is float:
+            if cur != cur or cur in [float('inf'), float('-inf')]:
+                return True
+            if exact and orjson.dumps(cur) != repr(cur).encode('UTF-8'):
+                return True
+    return False
+
+
+def escape_non_ascii(match):
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return f'\\u{code:04x}'
+    code -= 0x10000
+    return f'\\u{0xd800 | (code >> 10):04x}\\u{0xdc00 | (code & 0x3ff):04x}'
@@ -0,0 +1,79 @@
+class LineageGraph:
+    """
+    I index a node config so lookups by _id and by dataset are O(1) instead of scans over the whole config.
+    Pipes are the vertices and datasets are the edges, going from the pipe which produces a dataset to the pipes
+    which consume it.
+    """
+
+    def __init__(self):
+        self.confs = {}  # {<_id>: <conf>}
+        self.pipes = {}  # {<pipe _id>: {source: [<dataset>], sink: <dataset>}}
+        self.producers = {}  # {<dataset>: <pipe _id>}
+        self.consumers = {}  # {<dataset>: [<pipe _id>, ...]}
+        self._topological_order = None
+
+    def add_conf(self, conf: dict):
+        self.confs.setdefault(conf['_id'], conf)  # First one wins, same as scanning the config from the start
+
+    def remove_conf(self, conf: dict):
+        if self.confs.get(conf['_id']) is conf:
+            del self.confs[conf['_id']]
+
+    def add_pipe_flow(self, pipe_id: str, flow: dict):
+        self.pipes[pipe_id] = flow
+        self.producers.setdefault(flow['sink'], pipe_id)
+        for dataset in flow.get('source', []):
+            consumers = self.consumers.setdefault(dataset, [])
+            if pipe_id not in consumers:
+                consumers.append(pipe_id)
+        self._topological_order = None
+
+    def clear_pipe_flows(self):
+        self.pipes.clear()
+        self.producers = {}
+        self.consumers = {}
+        self._topological_order = None
+
+    def get_conf(self, _id: str):
+        return self.confs.get(_id)
+
+    def get_producer(self, dataset: str):
+        return self.producers.get(dataset)
+
+    def get_consumers(self, dataset: str):
+        return self.consumers.get(dataset, [])
+
+    def upstream(self, pipe_id: str):
+        """I return the pipes producing the datasets pipe_id reads from."""
+        sources = dict.fromkeys(self.pipes[pipe_id].get('source', []))
+        return [self.producers[d] for d in sources if d in self.producers]
+
+    def downstream(self, pipe_id: str):
+        """I return the pipes reading the dataset pipe_id writes to."""
+        sink = self.pipes[pipe_id]['sink']
+        if self.producers.get(sink) != pipe_id:
+            return []  # Another pipe is registered as producer of this dataset
+        return list(self.get_consumers(sink))
+
+    def topological_order(self):
+        """
+        I return every pipe so that producers come before their consumers. Pipes in a cycle come last in insertion
+        order. The result is cached until the pipe flows change.
+        """
+        if self._topological_order is None:
+            in_degree = {p: len(self.upstream(p)) for p in self.pipes}
+            ready = [p for p in self.pipes if in_degree[p] == 0]
+            order = []
+            while len(ready) != 0:
+                next_ready = []
+                for p in ready:
+                    order.append(p)
+                    for consumer in self.downstream(p):
+                        in_degree[consumer] -= 1
+                        if in_degree[consumer] == 0:
+                            next_ready.append(consumer)
+                ready = next_ready
+            ordered = set(order)
+            order.extend(p for p in self.pipes if p not in ordered)
+            self._topological_order = order
+        return self._topological_order
@@ -0,0 +1,14 @@
+from logging import getLogger
+
+from sesamutils import sesam_logger
+
+
+def get_logger(name: str):
+    """
+    I return the logger name, set up by sesam_logger the first time. sesam_logger adds a handler every time it is
+    called, so calling it for every new Node, Gitter, ... would print every line once per instance made so far.
+    """
+    logger = getLogger(name)
+    if len(logger.handlers) != 0:
+        return logger
+    return sesam_logger(name)
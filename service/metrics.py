@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import makedirs, path as os_path, replace
+from threading import Lock
+from time import perf_counter
+
+from json_backend import dump_json
+
+PREFIX = 'sesam_deployer_'
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]  # Seconds
+
+
+class Metrics:
+    """
+    I collect timing spans for the phases of a run, counters, gauges and latency histograms, and write them as a json report
+    or a Prometheus textfile at the end of the run. Every method is safe to call from several threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        I forget everything collected so far and start a new run, e.g. for every run in watch mode.
+        """
+        with self.lock:
+            self.started_at = datetime.now(timezone.utc)
+            self.start = perf_counter()
+            self.spans = []  # [{name, labels, start, seconds}, ...] in the order they finished
+            self.counters = {}  # {(<name>, <sorted label items>): <value>}
+            self.gauges = {}  # {(<name>, <sorted label items>): <last value>}
+            self.histograms = {}  # {(<name>, <sorted label items>): [<seconds>, ...]}
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        I time the block I wrap, also if it raises or exits.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            with self.lock:
+                self.spans.append({'name': name, 'labels': labels, 'start': start - self.start, 'seconds': seconds})
+
+    def count(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms.setdefault(key, []).append(seconds)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """
+        I observe how long the block I wrap takes in the histogram name.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return (list(self.spans), dict(self.counters), dict(self.gauges),
+                    {key: sorted(values) for key, values in self.histograms.items()})
+
+    def report(self):
+        spans, counters, gauges, histograms = self.snapshot()
+        return {
+            'started_at': self.started_at.isoformat(),
+            'seconds': perf_counter() - self.start,
+            'spans': spans,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(gauges.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': len(values), 'sum': sum(values),
+                            'p50': values[len(values) // 2],
+                            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+                            'max': values[-1]}
+                           for (name, labels), values in sorted(histograms.items())]
+        }
+
+    def prometheus(self):
+        """
+        I return the metrics in the Prometheus text format, for the node exporter's textfile collector.
+        """
+        spans, counters, gauges, histograms = self.snapshot()
+        lines = [f'# TYPE {PREFIX}run_seconds gauge',
+                 f'{PREFIX}run_seconds {perf_counter() - self.start}',
+                 f'# TYPE {PREFIX}run_timestamp_seconds gauge',
+                 f'{PREFIX}run_timestamp_seconds {self.started_at.timestamp()}']
+        span_seconds = {}
+        for span in spans:
+            key = tuple(sorted(dict(span['labels'], phase=span['name']).items()))
+            span_seconds[key] = span_seconds.get(key, 0) + span['seconds']
+        lines.append(f'# TYPE {PREFIX}phase_seconds gauge')
+        lines.extend(f'{PREFIX}phase_seconds{format_labels(labels)} {seconds}'
+                     for labels, seconds in sorted(span_seconds.items()))
+        for name in sorted({name for name, labels in counters}):
+            lines.append(f'# TYPE {PREFIX}{name}_total counter')
+            lines.extend(f'{PREFIX}{name}_total{format_labels(labels)} {value}'
+                         for (n, labels), value in sorted(counters.items()) if n == name)
+        for name in sorted({name for name, labels in gauges}):
+            lines.append(f'# TYPE {PREFIX}{name} gauge')
+            lines.extend(f'{PREFIX}{name}{format_labels(labels)} {value}'
+                         for (n, labels), value in sorted(gauges.items()) if n == name)
+        for name in sorted({name for name, labels in histograms}):
+            lines.append(f'# TYPE {PREFIX}{name}_seconds histogram')
+            for (n, labels), values in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bucket in BUCKETS + ['+Inf']:
+                    in_bucket = len(values) if bucket == '+Inf' else len([v for v in values if v <= bucket])
+                    lines.append(f'{PREFIX}{name}_seconds_bucket{format_labels(labels + (("le", str(bucket)),))} '
+                                 f'{in_bucket}')
+                lines.append(f'{PREFIX}{name}_seconds_sum{format_labels(labels)} {sum(values)}')
+                lines.append(f'{PREFIX}{name}_seconds_count{format_labels(labels)} {len(values)}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, report_file: str):
+        write_file(report_file, dump_json(self.report(), indent=2))
+
+    def write_prometheus(self, textfile: str):
+        write_file(textfile, self.prometheus())
+
+
+def format_labels(labels: tuple):
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def write_file(file_path: str, content: str):
+    directory = os_path.dirname(file_path)
+    if directory != '':
+        makedirs(directory, exist_ok=True)
+    tmp_file = f'{file_path}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(content)
+    replace(tmp_file, file_path)  # Atomic, so a collector never reads a half written file
+
+
+METRICS = Metrics()  # Shared by every module for the whole run
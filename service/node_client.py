@@ -0,0 +1,142 @@
+from email.utils import parsedate_to_datetime
+from gzip import compress
+from random import uniform
+from threading import Lock
+from time import perf_counter, sleep, time
+from zlib import compressobj
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from logger import get_logger
+
+from json_backend import dump_json_compact, iter_json
+from metrics import METRICS
+
+RETRYABLE_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+RETRY_AFTER_MAX = 120  # Seconds. A longer Retry-After is cut short, so a run can not hang on one request
+
+
+class NodeClient:
+    """
+    I am a pooled, keep-alive HTTP client for one node. Requests have connect and read timeouts, and transient
+    failures are retried with exponential backoff and full jitter, or as long as Retry-After asks for (capped) if the
+    node sends it. Other failures are returned at once. The latency of every request is recorded.
+    """
+
+    def __init__(self, jwt: str, pool_maxsize=8, connect_timeout=10, read_timeout=300, retries=5, backoff_base=1,
+                 backoff_max=30, gzip_min_size=None):
+        self.retries = retries
+        self.timeout = (connect_timeout, read_timeout)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.gzip_min_size = gzip_min_size  # Bodies of at least this many bytes are gzipped. None never gzips
+        self.session = Session()
+        self.session.headers.update({'Authorization': f'bearer {jwt}'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.latencies = []  # [(<method>, <seconds>), ...] for every request sent, including retries
+        self.lock = Lock()
+
+        self.LOGGER = get_logger('Node client')
+
+    def request(self, method: str, url: str, json=None, params=None, stream=False):
+        """
+        I return the last response, which is not ok if every try failed or the failure is not retryable.
+        Exceptions from the last try are raised.
+        If stream, json is encoded while it is sent, with chunked transfer encoding, so a large body like the node
+        config is never held in memory as a whole. It is encoded again for every try.
+        """
+        data, headers = self.encode_body(json) if not stream else (None, None)
+        for tries in range(self.retries):
+            last_try = tries == self.retries - 1
+            if stream:
+                data, headers = self.stream_body(json)
+            start = perf_counter()
+            try:
+                response = self.session.request(method, url, data=data, headers=headers, params=params,
+                                                timeout=self.timeout)
+            except (ConnectionError, Timeout) as e:
+                METRICS.count('sesam_api_requests', method=method, status='error')
+                if last_try:
+                    raise
+                wait = self.backoff(tries)
+                self.LOGGER.warning(f'Got exception "{e}" on {method} request to url "{url}". '
+                                    f'Try {tries + 1} of {self.retries}, retrying in {wait:.1f}s')
+                sleep(wait)
+                continue
+            finally:
+                seconds = perf_counter() - start
+                with self.lock:
+                    self.latencies.append((method, seconds))
+                METRICS.observe('sesam_api_request', seconds, method=method)
+            METRICS.count('sesam_api_requests', method=method, status=str(response.status_code))
+            if response.ok or response.status_code not in RETRYABLE_STATUS_CODES or last_try:
+                return response
+            wait = self.backoff(tries, response.headers.get('Retry-After'))
+            self.LOGGER.warning(f'Could not {method} request to url "{url}". Response: {response.status_code} '
+                                f'{response.content}. Try {tries + 1} of {self.retries}, retrying in {wait:.1f}s')
+            sleep(wait)
+
+    def encode_body(self, json):
+        if json is None:
+            return None, None
+        body = dump_json_compact(json)
+        headers = {'Content-Type': 'application/json'}
+        if self.gzip_min_size is not None and len(body) >= self.gzip_min_size:
+            body = compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def stream_body(self, json):
+        """
+        I return a generator of the encoded body and its headers. The size is not known up front, so the body is
+        gzipped whenever gzip_min_size is set.
+        """
+        if json is None:
+            return None, None
+        headers = {'Content-Type': 'application/json'}
+        if self.gzip_min_size is None:
+            return iter_json(json), headers
+        headers['Content-Encoding'] = 'gzip'
+        return gzip_chunks(iter_json(json)), headers
+
+    def backoff(self, tries: int, retry_after: str = None):
+        """
+        I return the seconds to wait before the next try. Retry-After, as seconds or a date, wins over backoff.
+        """
+        if retry_after is not None:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = parsedate_to_datetime(retry_after).timestamp() - time()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(RETRY_AFTER_MAX, max(0.0, seconds))
+        return uniform(0, min(self.backoff_max, self.backoff_base * 2 ** tries))
+
+    def reset_latencies(self):
+        with self.lock:
+            self.latencies = []
+
+    def get_latency_summary(self):
+        with self.lock:
+            latencies = sorted(seconds for method, seconds in self.latencies)
+        if len(latencies) == 0:
+            return 'No requests sent to the node.'
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return f'Sent {len(latencies)} requests to the node. Total: {sum(latencies):.2f}s, ' \
+               f'p50: {p50 * 1000:.0f}ms, p95: {p95 * 1000:.0f}ms, max: {latencies[-1] * 1000:.0f}ms.'
+
+
+def gzip_chunks(chunks):
+    compressor = compressobj(wbits=31)  # 31 writes a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if len(compressed) != 0:
+            yield compressed
+    yield compressor.flush()
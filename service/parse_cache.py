@@ -0,0 +1,85 @@
+from glob import glob
+from hashlib import sha256
+from os import makedirs, path as os_path, replace
+from threading import Lock
+
+from logger import get_logger
+
+from json_backend import load_json, write_json
+
+CACHE_FORMAT = 1
+
+
+def get_deployer_version():
+    """
+    I hash the source of the deployer itself, so any change to the code invalidates cached parse results.
+    """
+    hasher = sha256(str(CACHE_FORMAT).encode('UTF-8'))
+    for f in sorted(glob(os_path.join(os_path.dirname(os_path.abspath(__file__)), '*.py'))):
+        hasher.update(open(f, 'rb').read())
+    return hasher.hexdigest()
+
+
+class ParseCache:
+    """
+    I keep parsed config files on disk keyed by file path and content hash, so warm CI runs only parse changed files.
+    Each entry holds the parsed file, its pipe flow and the $ENV/$SECRET references it contains.
+    """
+
+    def __init__(self, cache_file: str, version: str = None):
+        self.cache_file = cache_file
+        self.version = version if version is not None else get_deployer_version()
+        self.entries = {}  # {<file path>: {hash: str, conf: dict, pipe_flow: dict, vars: list, secrets: list}}
+        self.used_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+        self.LOGGER = get_logger('Parse cache')
+        self.read()
+
+    def read(self):
+        try:
+            stored = load_json(open(self.cache_file, 'rb').read())
+        except FileNotFoundError:
+            self.LOGGER.info(f'No parse cache found at "{self.cache_file}". Starting cold.')
+            return
+        except ValueError as e:
+            self.LOGGER.warning(f'Ignoring unreadable parse cache "{self.cache_file}". Error: {e}')
+            return
+        if stored.get('version') != self.version:
+            self.LOGGER.info('Deployer version changed since parse cache was written. Starting cold.')
+            return
+        self.entries = stored.get('entries', {})
+
+    def get(self, file_path: str, content_hash: str):
+        entry = self.entries.get(file_path)
+        with self.lock:
+            if entry is not None and entry['hash'] == content_hash:
+                self.hits += 1
+                self.used_entries[file_path] = entry
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, file_path: str, entry: dict):
+        with self.lock:
+            self.entries[file_path] = entry
+            self.used_entries[file_path] = entry
+
+    def write(self):
+        """
+        I only keep entries used during this run, so files removed from the whitelist drop out of the cache.
+        """
+        directory = os_path.dirname(self.cache_file)
+        if directory != '':
+            makedirs(directory, exist_ok=True)
+        tmp_file = f'{self.cache_file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            write_json({'version': self.version, 'entries': self.used_entries}, f)
+        replace(tmp_file, self.cache_file)  # Atomic, so an interrupted run never leaves a half written cache
+        self.LOGGER.info(f'Parse cache: {self.hits} hits, {self.misses} misses. Written to "{self.cache_file}"')
+
+
+def content_hash(content: bytes):
+    return sha256(content).hexdigest()
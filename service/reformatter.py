@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import makedirs, path as os_path, replace
+from threading import Lock
+
+from logger import get_logger
+
+from json_backend import dump_json_compact, load_json, write_json
+
+CACHE_FILE_LOCK = Lock()  # Reformatters for different targets can share a cache file
+
+
+class Reformatter:
+    """
+    I reformat configs with the node's reformat-config endpoint, concurrently and memoized by a canonical hash of
+    each config. If a cache file is given, the memo is kept between runs, so unchanged running config is not sent
+    to the node again. The cache file holds one memo per namespace.
+    """
+
+    def __init__(self, post, max_workers=8, cache_file: str = None, namespace: str = ''):
+        self.post = post  # Function taking a config and returning the reformatted config as a string or None
+        self.max_workers = max_workers
+        self.cache_file = cache_file
+        self.namespace = namespace  # Part of the key, so formats from different nodes are kept apart
+        self.memo = {}  # {<canonical hash>: <reformatted config>}
+        self.used = set()  # Keys used in this run. Only these are written, so the cache does not grow forever
+        self.lock = Lock()
+        self.calls = 0
+        self.hits = 0
+
+        self.LOGGER = get_logger('Reformatter')
+        if self.cache_file is not None:
+            self.read()
+
+    def read(self):
+        memo = self.read_cache_file().get(self.namespace, {})
+        if type(memo) is dict:
+            self.memo = memo
+
+    def read_cache_file(self):
+        try:
+            cache = load_json(open(self.cache_file, 'rb').read())
+            if type(cache) is dict:
+                return cache
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            self.LOGGER.warning(f'Ignoring unreadable reformat cache "{self.cache_file}". Error: {e}')
+        return {}
+
+    def write(self):
+        if self.cache_file is None:
+            return
+        directory = os_path.dirname(self.cache_file)
+        if directory != '':
+            makedirs(directory, exist_ok=True)
+        with CACHE_FILE_LOCK:
+            cache = self.read_cache_file()  # Keeps the memos of other namespaces
+            cache[self.namespace] = {key: self.memo[key] for key in self.used if key in self.memo}
+            tmp_file = f'{self.cache_file}.tmp'
+            with open(tmp_file, 'wb') as f:
+                write_json(cache, f)
+            replace(tmp_file, self.cache_file)
+
+    def key(self, conf):
+        canonical = dump_json_compact(conf, sort_keys=True)
+        return sha256(f'{self.namespace}\n'.encode('UTF-8') + canonical).hexdigest()
+
+    def reformat(self, conf):
+        return self.reformat_with_key(self.key(conf), conf)
+
+    def reformat_with_key(self, key, conf):
+        with self.lock:
+            self.used.add(key)
+            if key in self.memo:
+                self.hits += 1
+                return self.memo[key]
+        formatted = self.post(conf)
+        with self.lock:
+            self.calls += 1
+            if formatted is not None:  # Failed calls are not memoized
+                self.memo[key] = formatted
+        return formatted
+
+    def reformat_all(self, confs: list):
+        """
+        I return the reformatted configs in the same order. Equal configs are only sent once.
+        """
+        keys = [self.key(conf) for conf in confs]
+        unique = {}
+        for key, conf in zip(keys, confs):
+            unique.setdefault(key, conf)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            formatted = dict(zip(unique, executor.map(self.reformat_with_key, unique.keys(), unique.values())))
+        self.LOGGER.info(f'Reformatted {len(confs)} configs with {self.calls} calls to the node '
+                         f'and {self.hits} memoized results.')
+        return [formatted[key] for key in keys]
@@ -0,0 +1,112 @@
+from re import compile as regex_compile
+
+from dotty_dict import dotty
+
+PLACEHOLDER_REGEX = regex_compile(r'#{2}(?:(REPLACE_ID)|(INBOUND_PARENT_PIPE|OUTBOUND_PARENT_PIPE)\.(.*?))#{2}')
+
+
+class TemplateParents:
+    """
+    I hold the inbound and outbound parent pipes a template is filled from, wrapped once for dotted lookups.
+    """
+
+    def __init__(self, inbound_parent_pipe: dict, outbound_parent_pipe: dict):
+        self.pipe_id = inbound_parent_pipe['_id']
+        self.dotted = {
+            'INBOUND_PARENT_PIPE': dotty(inbound_parent_pipe),
+            'OUTBOUND_PARENT_PIPE': dotty(outbound_parent_pipe)
+        }
+
+
+class CompiledTemplate:
+    """
+    I am a template compiled once into a tree where every string containing ##REPLACE_ID##,
+    ##INBOUND_PARENT_PIPE.<key>## or ##OUTBOUND_PARENT_PIPE.<key>## is split into literal parts and slots.
+    Rendering fills the slots straight into new dicts, without dumping and parsing the template again.
+    Parts of the template without slots are kept as constants and shared by every rendered config instead of copied,
+    so rendered config must not be changed.
+    """
+
+    def __init__(self, template, name: str = None):
+        self.name = name
+        self.template = template
+        self.slots = []  # [(<REPLACE_ID|INBOUND_PARENT_PIPE|OUTBOUND_PARENT_PIPE>, <key or None>), ...]
+        self.errors = []  # Errors found while compiling
+        self.root = self.compile(template)
+
+    def compile(self, template):
+        if type(template) is dict:
+            items = [(self.compile(k), self.compile(v)) for k, v in template.items()]
+            if all(k[0] == 'const' and v[0] == 'const' for k, v in items):
+                return 'const', template
+            return 'dict', items
+        if type(template) is list:
+            items = [self.compile(v) for v in template]
+            if all(v[0] == 'const' for v in items):
+                return 'const', template
+            return 'list', items
+        if type(template) is str and '##' in template:
+            parts = []
+            position = 0
+            for match in PLACEHOLDER_REGEX.finditer(template):
+                if match.start() != position:
+                    parts.append(template[position:match.start()])
+                if match.group(1) is not None:
+                    slot = ('REPLACE_ID', None)
+                else:
+                    slot = (match.group(2), match.group(3))
+                    if slot[1] == '':
+                        self.errors.append(f'Empty key in "{match.group(0)}" in template {self.name}')
+                parts.append(slot)
+                self.slots.append(slot)
+                position = match.end()
+            if position != 0:
+                if position != len(template):
+                    parts.append(template[position:])
+                return 'str', parts
+        return 'const', template
+
+    def render(self, replace_id: str, parents: TemplateParents = None, errors: list = None):
+        """
+        I return a new config with every ##REPLACE_ID## set to replace_id. Parent pipe slots are filled from parents,
+        or left as they are if parents is None. Missing keys are appended to errors instead of stopping.
+        """
+        if errors is None:
+            errors = []
+        return self.render_node(self.root, replace_id, parents, errors)
+
+    def render_node(self, node, replace_id, parents, errors):
+        kind, value = node
+        if kind == 'const':
+            return value
+        if kind == 'dict':
+            return {self.render_node(k, replace_id, parents, errors): self.render_node(v, replace_id, parents, errors)
+                    for k, v in value}
+        if kind == 'list':
+            return [self.render_node(v, replace_id, parents, errors) for v in value]
+        filled = [part if type(part) is str else self.fill_slot(part, replace_id, parents, errors) for part in value]
+        if len(filled) == 1:
+            return filled[0]  # The whole string is one slot, so the value is kept as it is
+        return ''.join(str(part) for part in filled)
+
+    def fill_slot(self, slot, replace_id, parents: TemplateParents, errors: list):
+        kind, key = slot
+        if kind == 'REPLACE_ID':
+            return replace_id
+        if parents is None:
+            return f'##{kind}.{key}##'
+        try:
+            return parents.dotted[kind][key]
+        except KeyError as e:
+            errors.append(f'Could not find keys: {key} in {kind.lower()} of parent pipe: {parents.pipe_id} '
+                          f'in template {self.name}. Error: {e}')
+            return ''
+
+
+def compile_template(template, name: str = None):
+    """
+    I compile a template file, which contains either one config or a list of configs.
+    """
+    if type(template) is list:
+        return [CompiledTemplate(t, name) for t in template]
+    return CompiledTemplate(template, name)
@@ -0,0 +1,54 @@
+from os import path as os_path, stat
+from threading import Lock
+
+from json_backend import load_json
+
+
+class VariableIndex:
+    """
+    I read each variables file once and map every variable to the files which define it, so the master node and
+    all extra nodes verify against one index, and every environment is checked in one pass.
+    A file is read again if it has been modified, e.g. between runs in watch mode.
+    """
+
+    def __init__(self):
+        self.files = {}  # {<absolute path>: (<modification time>, {<variable>: <value>})}
+        self.defined_in = {}  # {<variable>: {<absolute path>, ...}}
+        self.lock = Lock()
+
+    def get(self, file_path: str):
+        """
+        I return {<variable>: <value>} of a variables file. Do not change it, it is shared.
+        """
+        key = os_path.abspath(file_path)
+        signature = stat(file_path).st_mtime_ns
+        with self.lock:
+            if key not in self.files or self.files[key][0] != signature:
+                self.files[key] = (signature, load_json(open(file_path, 'rb').read()))
+                self.defined_in = {}
+                for path, (_, values) in self.files.items():
+                    for variable in values:
+                        self.defined_in.setdefault(variable, set()).add(path)
+            return self.files[key][1]
+
+    def missing(self, variables: list, file_paths: list):
+        """
+        I return {<file path>: [<variable>, ...]} of the variables each file does not define.
+        Files defining every variable are left out.
+        """
+        keys = [os_path.abspath(f) for f in file_paths]
+        for f in file_paths:
+            self.get(f)
+        gaps = {}
+        with self.lock:
+            for variable in variables:
+                defined_in = self.defined_in.get(variable, ())
+                if len(defined_in) == len(self.files):
+                    continue  # Defined in every file read, the common case
+                for f, key in zip(file_paths, keys):
+                    if key not in defined_in:
+                        gaps.setdefault(f, []).append(variable)
+        return {f: gaps[f] for f in file_paths if f in gaps}
+
+
+VARIABLE_INDEX = VariableIndex()  # Shared by every node for the whole run
@@ -0,0 +1,43 @@
+from os import path as os_path, stat, walk
+
+from logger import get_logger
+
+IGNORED_FOLDERS = ['.git']
+
+
+class FolderWatcher:
+    """
+    I poll a folder for added, changed and removed files. Polling needs no extra dependency and works the same on
+    every platform and in a container with a mounted folder, where file system events are not always delivered.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.signatures = self.scan()  # {<file path>: (<mtime in ns>, <size>)}
+
+        self.LOGGER = get_logger('Watcher')
+
+    def scan(self):
+        signatures = {}
+        for root, folders, files in walk(self.folder):
+            folders[:] = [f for f in folders if f not in IGNORED_FOLDERS]
+            for f in files:
+                file_path = os_path.join(root, f)
+                try:
+                    file_stat = stat(file_path)
+                except FileNotFoundError:  # Removed while scanning
+                    continue
+                signatures[file_path] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return signatures
+
+    def changes(self):
+        """
+        I return the paths of the files which were added, changed or removed since I was last asked.
+        """
+        signatures = self.scan()
+        changed = [p for p in signatures.keys() | self.signatures.keys()
+                   if signatures.get(p) != self.signatures.get(p)]
+        self.signatures = signatures
+        if len(changed) != 0:
+            self.LOGGER.debug(f'Changed files: {sorted(changed)}')
+        return sorted(changed)
@@ -0,0 +1,19 @@
+from os import path as os_path
+import sys
+
+import pytest
+
+ROOT = os_path.dirname(os_path.dirname(os_path.abspath(__file__)))
+# The service modules import each other by name, like when deployer.py is run from service/
+sys.path.insert(0, os_path.join(ROOT, 'service'))
+sys.path.insert(0, os_path.join(ROOT, 'benchmarks'))
+
+
+@pytest.fixture(autouse=True)
+def node_clients(monkeypatch):
+    """
+    I give every test new node clients, made with that test's settings. Clients are kept per url, and a stand-in
+    can get the port of one from an earlier test.
+    """
+    import deployer
+    monkeypatch.setattr(deployer, 'NODE_CLIENTS', {})
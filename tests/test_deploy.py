@@ -0,0 +1,209 @@
+from json import dumps as dump_json
+from os import path as os_path
+from types import SimpleNamespace
+
+import pytest
+
+import deployer
+from node_client import NodeClient
+from stand_in import StandIn
+
+RUNNING_CONF = [
+    {'_id': 'node', 'type': 'metadata', 'global_defaults': {'use_signalling_internally': False}},
+    {'_id': 'changed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'a'}},
+    {'_id': 'kept-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'b'}},
+    {'_id': 'removed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'c'}},
+    {'_id': 'removed-system', 'type': 'system:url', 'url_pattern': 'http://c/%s'}
+]
+NODE_CONF = [
+    RUNNING_CONF[0],
+    {'_id': 'changed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'x'}},
+    RUNNING_CONF[2],
+    {'_id': 'added/pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'd'}},
+    {'_id': 'added-system', 'type': 'system:url', 'url_pattern': 'http://d/%s'}
+]
+FULL_PUT = ('PUT', '/api/config')
+NODE_FOLDER = os_path.join(os_path.dirname(os_path.dirname(os_path.abspath(__file__))), 'template_node_root_folder')
+WRITES = ['PUT', 'POST', 'DELETE']
+
+
+@pytest.fixture
+def node():
+    return SimpleNamespace(conf=NODE_CONF, upload_vars={'a': 1}, upload_secrets={})
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    monkeypatch.setattr(deployer.config, 'DEPLOY_MODE', 'incremental', raising=False)
+    monkeypatch.setattr(deployer.config, 'HTTP_RETRIES', 1, raising=False)  # Fail without waiting for retries
+    stand_in = StandIn(RUNNING_CONF).start()
+    yield stand_in
+    stand_in.stop()
+
+
+def diff_and_deploy(stand_in, node, failing=()):
+    diff = deployer.do_diff(stand_in.url, 'jwt', node)
+    stand_in.calls.clear()
+    stand_in.failing.update(dict.fromkeys(failing))  # Only requests made while deploying fail, every time
+    return diff, deployer.deploy(stand_in.url, 'jwt', True, False, node, diff=diff)
+
+
+def writes(stand_in):
+    return [call for call in stand_in.calls if call[0] in WRITES]
+
+
+def test_deploys_only_the_diff(stand_in, node):
+    diff, code = diff_and_deploy(stand_in, node)
+
+    assert code == 0
+    assert sorted(diff.added) == ['added-system', 'added/pipe']
+    assert list(diff.changed) == ['changed-pipe']
+    assert sorted(diff.removed) == ['removed-pipe', 'removed-system']
+    assert FULL_PUT not in stand_in.calls
+    assert writes(stand_in) == [
+        ('PUT', '/api/env'),
+        ('POST', '/api/systems'),
+        ('POST', '/api/pipes'),
+        ('PUT', '/api/pipes/changed-pipe/config'),
+        ('DELETE', '/api/pipes/removed-pipe'),
+        ('DELETE', '/api/systems/removed-system')
+    ]
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+    assert stand_in.env == node.upload_vars
+
+
+def test_deploys_nothing_when_unchanged(stand_in, node):
+    stand_in.running_conf = {c['_id']: c for c in node.conf}
+    stand_in.env = node.upload_vars
+
+    diff, code = diff_and_deploy(stand_in, node)
+
+    assert code == 0
+    assert diff.is_empty()
+    assert writes(stand_in) == [('PUT', '/api/env')]
+
+
+def test_falls_back_to_full_put_for_metadata_changes(stand_in, node):
+    node.conf = [dict(NODE_CONF[0], global_defaults={'use_signalling_internally': True})] + NODE_CONF[1:]
+
+    _, code = diff_and_deploy(stand_in, node)
+
+    assert code == 0
+    assert writes(stand_in) == [('PUT', '/api/env'), FULL_PUT]
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+
+
+@pytest.mark.parametrize('failing', ['/api/systems', '/api/pipes/changed-pipe/config', '/api/pipes/removed-pipe'])
+def test_falls_back_to_full_put_when_a_request_fails(stand_in, node, failing):
+    _, code = diff_and_deploy(stand_in, node, [failing])
+
+    assert code == 0
+    assert writes(stand_in)[-1] == FULL_PUT
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+
+
+def test_fails_when_the_full_put_fails(stand_in, node):
+    _, code = diff_and_deploy(stand_in, node, ['/api/pipes', '/api/config'])
+
+    assert code == -5
+
+
+def test_full_deploy_mode_puts_the_node_config(stand_in, node, monkeypatch):
+    monkeypatch.setattr(deployer.config, 'DEPLOY_MODE', 'full')
+
+    _, code = diff_and_deploy(stand_in, node)
+
+    assert code == 0
+    assert writes(stand_in) == [('PUT', '/api/env'), FULL_PUT]
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+
+
+@pytest.mark.parametrize('gzip_min_size', [None, 1], ids=['plain', 'gzip'])
+def test_streams_the_node_config(stand_in, node, monkeypatch, gzip_min_size):
+    monkeypatch.setattr(deployer.config, 'DEPLOY_MODE', 'full')
+    monkeypatch.setattr(deployer.config, 'HTTP_STREAM_CONFIG', True, raising=False)
+    monkeypatch.setattr(deployer.config, 'HTTP_GZIP_MIN_SIZE', gzip_min_size, raising=False)
+
+    _, code = diff_and_deploy(stand_in, node)
+
+    assert code == 0
+    assert writes(stand_in) == [('PUT', '/api/env'), FULL_PUT]
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+
+
+def test_streams_the_node_config_again_on_retry(stand_in, node, monkeypatch):
+    monkeypatch.setattr(deployer.config, 'DEPLOY_MODE', 'full')
+    monkeypatch.setattr(deployer.config, 'HTTP_STREAM_CONFIG', True, raising=False)
+    monkeypatch.setattr(deployer.config, 'HTTP_RETRIES', 2)
+    monkeypatch.setattr(NodeClient, 'backoff', lambda *args: 0)
+    diff = deployer.do_diff(stand_in.url, 'jwt', node)
+    stand_in.failing['/api/config'] = 1
+
+    code = deployer.deploy(stand_in.url, 'jwt', False, False, node, diff=diff)
+
+    assert code == 0
+    assert writes(stand_in) == [FULL_PUT, FULL_PUT]
+    assert stand_in.running_conf == {c['_id']: c for c in node.conf}
+
+
+def target(stand_in):
+    return {'URL': stand_in.url, 'JWT': 'jwt', 'UPLOAD_VARIABLES': False, 'UPLOAD_SECRETS': False}
+
+
+@pytest.fixture
+def stand_ins():
+    stand_ins = [StandIn(RUNNING_CONF).start() for _ in range(3)]
+    yield stand_ins
+    for stand_in in stand_ins:
+        stand_in.stop()
+
+
+def test_a_failing_target_does_not_stop_the_others(stand_in, stand_ins, node):
+    ok, failing_put, failing_get = stand_ins
+    failing_put.failing.update({'/api/pipes': None, ('PUT', '/api/config'): None})
+    failing_get.failing['/api/config'] = None  # do_diff can not diff against nothing, and raises
+
+    results = deployer.deploy_to_targets([target(ok), target(failing_put), target(failing_get)], node)
+
+    assert results == {ok.url: 0, failing_put.url: -5, failing_get.url: -7}
+    assert ok.running_conf == {c['_id']: c for c in node.conf}
+    assert writes(failing_put)[-1] == FULL_PUT  # The fallback was tried
+
+
+def test_a_single_failing_target_gets_a_result(stand_in, node):
+    stand_in.failing['/api/config'] = None
+
+    assert deployer.deploy_to_targets([target(stand_in)], node) == {stand_in.url: -7}
+
+
+@pytest.fixture
+def loaded_config(monkeypatch, stand_ins):
+    """
+    I load the config from the environment into a new config, with stand-ins as the MASTER_NODE targets.
+    """
+    monkeypatch.setattr(deployer, 'config', deployer.AppConfig())
+    for name in ['env', 'path', 'verify_variables', 'verify_secrets', 'dry_run']:
+        monkeypatch.setattr(deployer, name, getattr(deployer, name))  # Set again by load_config, restored after
+    monkeypatch.setenv('ENVIRONMENT', 'test')
+    monkeypatch.setenv('NODE_FOLDER', NODE_FOLDER)
+    monkeypatch.setenv('VERIFY_VARIABLES', 'false')
+    monkeypatch.setenv('VERIFY_SECRETS', 'false')
+    monkeypatch.setenv('DRY_RUN', 'false')
+    monkeypatch.setenv('HTTP_RETRIES', '1')
+    monkeypatch.setenv('MASTER_NODE', dump_json([target(stand_in) for stand_in in stand_ins]))
+    monkeypatch.delenv('EXTRA_NODES', raising=False)
+    deployer.load_config()
+    return stand_ins
+
+
+def test_main_exits_with_the_code_of_the_first_failed_target(loaded_config):
+    ok, failing_put, failing_get = loaded_config
+    failing_put.failing[('PUT', '/api/config')] = None
+    failing_get.failing['/api/config'] = None
+
+    with pytest.raises(SystemExit) as exit_info:
+        deployer.main('deploy')
+
+    assert exit_info.value.code == -5
+    assert FULL_PUT in ok.calls
+    assert 'global-kunde' in ok.running_conf  # From the node folder
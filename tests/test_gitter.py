@@ -0,0 +1,143 @@
+from subprocess import run
+from types import SimpleNamespace
+
+import pytest
+from git import Repo
+
+from gitter import Gitter, node_files, write_object, write_tree
+
+BRANCH = 'main'
+OLD_CONF = [
+    {'_id': 'node', 'type': 'metadata', 'global_defaults': {'use_signalling_internally': False}},
+    {'_id': 'changed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'a'}},
+    {'_id': 'removed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'b'}},
+    {'_id': 'kept-system', 'type': 'system:url', 'url_pattern': 'http://a/%s'}
+]
+NEW_CONF = [
+    OLD_CONF[0],
+    {'_id': 'changed-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'c'}},
+    OLD_CONF[3],
+    {'_id': 'added-pipe', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': 'd'}}
+]
+OTHER_FILES = {'README.md': b'Extra node\n', 'ci/pipeline.yml': b'steps: []\n', 'node-notes.txt': b'Not in node/\n'}
+
+# Both ways of writing the node files, each with and without a mirror of the remote repo
+MODES = [
+    pytest.param(True, False, id='worktree'),
+    pytest.param(True, True, id='worktree-mirror'),
+    pytest.param(False, False, id='worktreeless'),
+    pytest.param(False, True, id='worktreeless-mirror')
+]
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for kind in ['AUTHOR', 'COMMITTER']:
+        monkeypatch.setenv(f'GIT_{kind}_NAME', 'Deployer test')
+        monkeypatch.setenv(f'GIT_{kind}_EMAIL', 'deployer@example.com')
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """
+    I return the file:// url of a bare repo with the old node files and files outside node/ on the branch.
+    """
+    work = tmp_path / 'seed'
+    files = dict(OTHER_FILES, **{f'node/{f}': c for f, c in node_files(make_node(OLD_CONF), 'test').items()})
+    for filename, content in files.items():
+        (work / filename).parent.mkdir(parents=True, exist_ok=True)
+        (work / filename).write_bytes(content)
+    git(work.parent, 'init', '-q', '-b', BRANCH, str(work))
+    git(work, 'add', '-A')
+    git(work, 'commit', '-q', '-m', 'Initial node config')
+    git(tmp_path, 'clone', '-q', '--bare', str(work), str(tmp_path / 'remote.git'))
+    return f'file://{tmp_path / "remote.git"}'
+
+
+def make_node(conf, upload_vars=None):
+    return SimpleNamespace(conf=conf, upload_vars=upload_vars or {})
+
+
+def git(cwd, *args, input=None):
+    return run(['git', *args], cwd=cwd, input=input, check=True, capture_output=True, text=True).stdout
+
+
+def remote_path(url):
+    return url[len('file://'):]
+
+
+def branch_files(url):
+    """
+    I return {<path>: <content>} of every file on the branch of the remote repo.
+    """
+    tree = Repo(remote_path(url)).commit(BRANCH).tree
+    return {blob.path: blob.data_stream.read() for blob in tree.traverse() if blob.type == 'blob'}
+
+
+def update(url, tmp_path, worktree, mirror, node, name='extra'):
+    repo = Gitter(url, None, None, str(tmp_path / name), BRANCH,
+                  mirror_folder=str(tmp_path / 'mirrors') if mirror else None, worktree=worktree)
+    repo.create_node_file_structure(node, 'test')
+    repo.push_if_diff()
+    return repo
+
+
+@pytest.mark.parametrize('worktree,mirror', MODES)
+def test_pushes_added_changed_and_removed_files(remote, tmp_path, worktree, mirror):
+    old_head = Repo(remote_path(remote)).commit(BRANCH)
+    node = make_node(NEW_CONF, {'a': 1})
+
+    repo = update(remote, tmp_path, worktree, mirror, node)
+
+    assert repo.changes == {
+        'added': ['pipes/added-pipe.conf.json', 'variables/variables-test.json'],
+        'changed': ['pipes/changed-pipe.conf.json'],
+        'removed': ['pipes/removed-pipe.conf.json']
+    }
+    expected = dict(OTHER_FILES, **{f'node/{f}': c for f, c in node_files(node, 'test').items()})
+    assert branch_files(remote) == expected
+    assert Repo(remote_path(remote)).commit(BRANCH).parents == (old_head,)
+    git(remote_path(remote), 'fsck', '--strict')
+
+
+@pytest.mark.parametrize('worktree,mirror', MODES)
+def test_pushes_again_from_a_warm_mirror(remote, tmp_path, worktree, mirror):
+    update(remote, tmp_path, worktree, mirror, make_node(NEW_CONF))
+    node = make_node(NEW_CONF[:2])
+
+    repo = update(remote, tmp_path, worktree, mirror, node)
+
+    assert repo.changes == {
+        'added': [],
+        'changed': [],
+        'removed': ['pipes/added-pipe.conf.json', 'systems/kept-system.conf.json']
+    }
+    expected = dict(OTHER_FILES, **{f'node/{f}': c for f, c in node_files(node, 'test').items()})
+    assert branch_files(remote) == expected
+    assert len(list(Repo(remote_path(remote)).iter_commits(BRANCH))) == 3
+    git(remote_path(remote), 'fsck', '--strict')
+
+
+@pytest.mark.parametrize('worktree,mirror', MODES)
+def test_does_not_commit_unchanged_files(remote, tmp_path, worktree, mirror):
+    old_head = Repo(remote_path(remote)).commit(BRANCH)
+
+    repo = update(remote, tmp_path, worktree, mirror, make_node(OLD_CONF))
+
+    assert repo.changes == {'added': [], 'changed': [], 'removed': []}
+    assert not repo.is_there_a_diff()
+    assert Repo(remote_path(remote)).commit(BRANCH) == old_head
+
+
+def test_write_tree_sorts_entries_like_git(tmp_path):
+    repo = Repo.init(tmp_path / 'repo.git', bare=True)
+    blob = write_object(repo, b'blob', b'{}\n')
+    # A folder sorts as if its name ended with a slash, so folder "a" comes after files "a-b" and "a.b"
+    tree = {'a': {'b': blob}, 'a.b': blob, 'a-b': blob, 'b': {'c': {'d': blob}}}
+
+    binsha = write_tree(repo, tree)
+
+    listing = git(repo.git_dir, 'ls-tree', binsha.hex())
+    assert [line.split('\t')[1] for line in listing.splitlines()] == ['a-b', 'a.b', 'a', 'b']
+    assert git(repo.git_dir, 'mktree', input=listing).strip() == binsha.hex()  # git sorts the entries itself
+    git(repo.git_dir, 'fsck', '--strict')
@@ -0,0 +1,97 @@
+from json import dumps as dump_json, load as load_json_file
+from random import Random
+from time import sleep
+
+import pytest
+
+import deployer
+from reformatter import Reformatter
+from stand_in import StandIn
+
+REFORMAT_PATH = '/api/utils/reformat-config'
+CONFS = [{'_id': f'pipe-{i}', 'type': 'pipe', 'source': {'type': 'dataset', 'dataset': f'd{i}'}} for i in range(20)]
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = StandIn().start()
+    yield stand_in
+    stand_in.stop()
+
+
+def make_post(stand_in, jitter=0.0):
+    """
+    I return a post function like do_diff's, which waits up to jitter seconds first, so replies come back in any
+    order.
+    """
+    client = deployer.get_node_client(stand_in.url, 'jwt')
+    random = Random(1)
+
+    def post(conf):
+        sleep(random.uniform(0, jitter))
+        return deployer.do_post(client, url=f'{stand_in.url}{REFORMAT_PATH}', json=conf)
+    return post
+
+
+def formatted(conf):
+    return dump_json(conf, indent=2, sort_keys=True)  # What the stand-in replies with
+
+
+def reformat_calls(stand_in):
+    return len([call for call in stand_in.calls if call[1] == REFORMAT_PATH])
+
+
+def test_reformats_in_input_order_and_posts_equal_configs_once(stand_in):
+    reformatter = Reformatter(make_post(stand_in, jitter=0.02), max_workers=8)
+    reordered = {key: CONFS[3][key] for key in reversed(CONFS[3])}  # Equal to CONFS[3], keys in another order
+    confs = CONFS + CONFS[::2] + [reordered]
+
+    results = reformatter.reformat_all(confs)
+
+    assert results == [formatted(conf) for conf in confs]
+    assert reformat_calls(stand_in) == len(CONFS)
+    assert (reformatter.calls, reformatter.hits) == (len(CONFS), 0)
+
+
+def test_memo_is_kept_per_namespace_in_the_cache_file(stand_in, tmp_path):
+    cache_file = str(tmp_path / 'cache' / 'reformat.json')
+    first = Reformatter(make_post(stand_in), cache_file=cache_file, namespace='node-a')
+    first.reformat_all(CONFS)
+    first.write()
+    calls = reformat_calls(stand_in)
+
+    second = Reformatter(make_post(stand_in), cache_file=cache_file, namespace='node-a')
+    assert second.reformat_all(CONFS) == [formatted(conf) for conf in CONFS]
+    assert reformat_calls(stand_in) == calls
+
+    other = Reformatter(make_post(stand_in), cache_file=cache_file, namespace='node-b')
+    other.reformat_all(CONFS[:5])
+    other.write()
+    assert reformat_calls(stand_in) == calls + 5  # Formats from another node are not used
+
+    cache = load_json_file(open(cache_file))
+    assert sorted(cache) == ['node-a', 'node-b']  # Writing one namespace keeps the others
+    assert (len(cache['node-a']), len(cache['node-b'])) == (len(CONFS), 5)
+
+
+def test_only_configs_used_in_the_run_are_written(stand_in, tmp_path):
+    cache_file = str(tmp_path / 'reformat.json')
+    first = Reformatter(make_post(stand_in), cache_file=cache_file)
+    first.reformat_all(CONFS)
+    first.write()
+
+    second = Reformatter(make_post(stand_in), cache_file=cache_file)
+    second.reformat_all(CONFS[:5])
+    second.write()
+
+    assert len(load_json_file(open(cache_file))['']) == 5
+
+
+def test_failed_reformats_are_not_memoized(stand_in, monkeypatch):
+    monkeypatch.setattr(deployer.config, 'HTTP_RETRIES', 1, raising=False)
+    stand_in.failing[REFORMAT_PATH] = 1
+    reformatter = Reformatter(make_post(stand_in), max_workers=1)
+
+    assert reformatter.reformat_all(CONFS[:2]) == [None, formatted(CONFS[1])]
+    assert reformatter.reformat_all(CONFS[:2]) == [formatted(conf) for conf in CONFS[:2]]
+    assert reformat_calls(stand_in) == 3
@@ -0,0 +1,119 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from Vaulter import Vaulter
+from stand_in import StandIn
+
+MOUNT_POINT = 'sesam'
+SECRETS = [f'secret-{i}' for i in range(100)]
+MISSING = SECRETS[::7]
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = StandIn(latency=0.005, missing_secrets=MISSING).start()
+    yield stand_in
+    stand_in.stop()
+
+
+def make_vaulter(stand_in, **kwargs):
+    return Vaulter(url=stand_in.url, token='token', mount_point=MOUNT_POINT, **kwargs)
+
+
+def secret_reads(stand_in):
+    """
+    I return {<secret>: <number of times it was read from vault>}.
+    """
+    prefix = f'/v1/{MOUNT_POINT}/data/'
+    return Counter(path[len(prefix):] for method, path in stand_in.calls if path.startswith(prefix))
+
+
+def test_reads_every_secret_once_concurrently(stand_in):
+    vaulter = make_vaulter(stand_in, max_workers=8)
+
+    values = vaulter.get_secrets(SECRETS + SECRETS[::3])  # Secrets used by several configs are listed again
+
+    assert list(values) == SECRETS
+    assert values == {s: None if s in MISSING else f'value-of-{s}' for s in SECRETS}
+    assert sorted(vaulter.missing_secrets) == sorted(MISSING)
+    assert secret_reads(stand_in) == Counter(SECRETS)
+    assert not vaulter.verify(SECRETS)
+    assert vaulter.verify([s for s in SECRETS if s not in MISSING])
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_second_run_is_served_from_the_cache(stand_in):
+    vaulter = make_vaulter(stand_in, max_workers=8)
+    vaulter.get_secrets(SECRETS)
+    stand_in.calls.clear()
+
+    values = vaulter.get_secrets(SECRETS)
+
+    assert secret_reads(stand_in) == Counter()  # Known missing secrets are not read again either
+    assert values == {s: None if s in MISSING else f'value-of-{s}' for s in SECRETS}
+    assert sorted(vaulter.missing_secrets) == sorted(MISSING)
+    assert vaulter.cache_hits == len(SECRETS)
+
+
+def test_expired_secrets_are_read_again(stand_in):
+    clock = Clock()
+    vaulter = make_vaulter(stand_in, cache_ttl=300, clock=clock)
+    vaulter.get_secrets(SECRETS[:10])
+    stand_in.calls.clear()
+
+    clock.now = 299
+    vaulter.get_secrets(SECRETS[:10])
+    assert secret_reads(stand_in) == Counter()
+
+    clock.now = 301
+    vaulter.get_secrets(SECRETS[:10])
+    assert secret_reads(stand_in) == Counter(SECRETS[:10])
+
+
+def test_secret_added_to_vault_is_no_longer_missing_after_expiry(stand_in):
+    clock = Clock()
+    vaulter = make_vaulter(stand_in, cache_ttl=300, clock=clock)
+    vaulter.get_secrets(MISSING[:1])
+    assert vaulter.missing_secrets == MISSING[:1]
+
+    stand_in.missing_secrets = []
+    clock.now = 301
+    values = vaulter.get_secrets(MISSING[:1])
+
+    assert values == {MISSING[0]: f'value-of-{MISSING[0]}'}
+    assert vaulter.missing_secrets == []
+
+
+def test_least_recently_used_secrets_over_cache_size_are_read_again(stand_in):
+    vaulter = make_vaulter(stand_in, max_workers=1, cache_size=5)  # One worker, so the order of use is known
+    vaulter.get_secrets(SECRETS[:5])
+    vaulter.get_secrets(SECRETS[:1])  # Used last, so kept
+    stand_in.calls.clear()
+
+    vaulter.get_secrets(SECRETS[5:7])
+    vaulter.get_secrets(SECRETS[:5])
+
+    assert len(vaulter.cache) == 5
+    assert set(secret_reads(stand_in)) == set(SECRETS[1:7])
+    assert secret_reads(stand_in)[SECRETS[0]] == 0
+
+
+def test_concurrent_reads_of_one_secret_go_to_vault_once(stand_in):
+    stand_in.latency = 0.05  # Long enough for every thread to wait for the first read
+    vaulter = make_vaulter(stand_in, max_workers=8)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(vaulter.get_secret, [SECRETS[1]] * 8 + [MISSING[0]] * 8))
+
+    assert values == [f'value-of-{SECRETS[1]}'] * 8 + [None] * 8
+    assert secret_reads(stand_in) == Counter([SECRETS[1], MISSING[0]])
+    assert vaulter.missing_secrets == [MISSING[0]]